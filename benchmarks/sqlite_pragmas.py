@@ -0,0 +1,148 @@
+#!/usr/bin/python
+'''
+Compare the storage profiles in pmail.common.STORAGE_PROFILES.
+
+For each profile this measures:
+  sync: the time taken by a commit of a small batch of label changes, which
+  is what the syncer does for every history update.
+  list: the time taken to fetch a page of the INBOX while a writer is
+  committing label changes in another thread, i.e. what the client sees
+  while the server syncs.
+
+Run with:
+
+    python -m benchmarks.sqlite_pragmas [number of messages] [directory]
+
+The databases are created in a temporary directory inside directory (default
+the current directory). Note that /tmp is often a tmpfs, where fsync is free,
+so it is a poor place to run this.
+'''
+
+# ---> Imports
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+from threading import Thread, Event
+from time import perf_counter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from pmail.common import (Base, MessageInfo, Labels, STORAGE_PROFILES,
+                          setPragmas)
+from pmail.server import MessageView
+# <---
+
+ACCOUNT = 'someone@gmail.com'
+LABELS = ['INBOX', 'UNREAD', 'IMPORTANT', 'CATEGORY_PERSONAL', 'Label_12']
+BATCH = 20
+COMMITS = 200
+
+
+def mkSessionmaker(path, pragmas, numOfMessages):
+  engine = create_engine('sqlite:///' + path)
+  setPragmas(engine, pragmas)
+  Base.metadata.create_all(engine)
+  mkSession = sessionmaker(bind=engine, expire_on_commit=False)
+  session = mkSession()
+  for i in range(numOfMessages):
+    messageId = '{:016x}'.format(0x170000000000 + i)
+    session.add(MessageInfo(
+        messageId, ACCOUNT, str(1000 + i), 1590000000000 + i * 60000,
+        12345 + i, 'A snippet of the message, about a hundred characters ' +
+        'long, which is what gmail usually sends.', '<{}@mail>'.format(i),
+        'Subject number {}'.format(i), 'Some Body <somebody@example.com>',
+        None, None, None, ACCOUNT + ', other@example.com', 'text/plain'))
+    session.add_all([Labels(messageId, label)
+                     for label in LABELS[:2 + i % 4]])
+  session.commit()
+  session.close()
+  return mkSession
+
+
+def messageIds(numOfMessages, i):
+  return ['{:016x}'.format(0x170000000000 + (i * BATCH + j) % numOfMessages)
+          for j in range(BATCH)]
+
+
+def sync(mkSession, numOfMessages, stop=None):
+  '''
+  Add the STARRED label to a batch of messages and then remove it again, one
+  commit each time.
+
+  Returns:
+    A list of the time taken by each commit, in seconds.
+  '''
+  session = mkSession()
+  times = []
+  i = 0
+  while (stop is None and i < COMMITS) or (stop is not None and
+                                          not stop.is_set()):
+    labels = [(messageId, ['STARRED']) for messageId in
+              messageIds(numOfMessages, i // 2)]
+    start = perf_counter()
+    if i % 2 == 0:
+      Labels.addLabels(session, labels)
+    else:
+      Labels.removeLabels(session, labels)
+    times.append(perf_counter() - start)
+    i += 1
+  session.close()
+  return times
+
+
+def listWhileSyncing(mkSession, numOfMessages):
+  '''
+  Fetch pages of the INBOX while another thread commits label changes.
+
+  Returns:
+    A list of the time taken by each page, in seconds.
+  '''
+  stop = Event()
+  writer = Thread(target=sync, args=(mkSession, numOfMessages, stop))
+  writer.start()
+  times = []
+  try:
+    for i in range(COMMITS):
+      session = mkSession()
+      start = perf_counter()
+      view = MessageView(ACCOUNT, None, ['INBOX'], ['TRASH', 'SPAM'])
+      view.page(session, (i * 37) % numOfMessages, 60)
+      view.getCount(session)
+      times.append(perf_counter() - start)
+      session.close()
+  finally:
+    stop.set()
+    writer.join()
+  return times
+
+
+def ms(times):
+  times = sorted(times)
+  return (statistics.median(times) * 1000,
+          times[int(len(times) * 0.99) - 1] * 1000)
+
+
+def main(numOfMessages, directory):
+  tmp = tempfile.mkdtemp(dir=directory)
+  try:
+    print('{} messages, {} commits of {} label changes.'
+          .format(numOfMessages, COMMITS, BATCH))
+    print('{:<10}{:>18}{:>18}{:>18}{:>18}'.format(
+        'profile', 'sync median (ms)', 'sync p99 (ms)',
+        'list median (ms)', 'list p99 (ms)'))
+    for profile, pragmas in STORAGE_PROFILES.items():
+      mkSession = mkSessionmaker(os.path.join(tmp, profile + '.db'), pragmas,
+                                 numOfMessages)
+      syncTimes = ms(sync(mkSession, numOfMessages))
+      listTimes = ms(listWhileSyncing(mkSession, numOfMessages))
+      print('{:<10}{:>18.2f}{:>18.2f}{:>18.2f}{:>18.2f}'.format(
+          profile, *syncTimes, *listTimes))
+  finally:
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  numOfMessages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  directory = sys.argv[2] if len(sys.argv) > 2 else '.'
+  main(numOfMessages, directory)
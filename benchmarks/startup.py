@@ -0,0 +1,98 @@
+#!/usr/bin/python
+'''
+Time cold starts, each in a fresh interpreter.
+
+  unread: python -m pmail -n ID, which status bars run every few seconds.
+  service: import pmail.common and build a gmail service object, once with
+  the discovery cache empty, so the discovery document has to be fetched,
+  and once with it filled by the previous run.
+
+Run with:
+
+    python -m benchmarks.startup [runs]
+
+The empty cache runs need network access. Without it they fail, and the
+cache is filled from the discovery document which newer versions of the api
+client ship with. The discovery cache used is a temporary directory, the
+real one is not touched.
+'''
+
+# ---> Imports
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+import uritemplate
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import DISCOVERY_URI
+from pmail.common import config, DiscoveryCache
+# <---
+
+SERVICE = '''
+import sys
+from pmail import common
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+common.DiscoveryCache.directory = sys.argv[1]
+build('gmail', 'v1', http=build_http(), cache=common.DiscoveryCache(),
+      static_discovery=False)
+'''
+
+
+def timeRuns(args, runs, before=None):
+  '''
+  Returns:
+    A list of wall times in seconds, or None if the command failed.
+  '''
+  times = []
+  for _ in range(runs):
+    if before:
+      before()
+    start = perf_counter()
+    done = subprocess.run(args, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+    times.append(perf_counter() - start)
+    if done.returncode != 0:
+      return None
+  return times
+
+
+def report(name, times):
+  if times is None:
+    print('{:<24}{:>14}'.format(name, 'failed'))
+  else:
+    print('{:<24}{:>14.0f}{:>14.0f}'.format(
+        name, statistics.median(times) * 1000, min(times) * 1000))
+
+
+def main(runs):
+  accountId = list(config.listAccountIds())[0]
+  print('{} runs each.'.format(runs))
+  print('{:<24}{:>14}{:>14}'.format('', 'median (ms)', 'best (ms)'))
+  report('python', timeRuns([sys.executable, '-c', 'pass'], runs))
+  report('pmail -n ' + accountId,
+         timeRuns([sys.executable, '-m', 'pmail', '-n', accountId], runs))
+
+  directory = tempfile.mkdtemp()
+  try:
+    service = [sys.executable, '-c', SERVICE, directory]
+    report('service, empty cache', timeRuns(
+        service, runs, lambda: [os.remove(os.path.join(directory, f))
+                                for f in os.listdir(directory)]))
+    if not os.listdir(directory):
+      DiscoveryCache.directory = directory
+      DiscoveryCache().set(
+          uritemplate.expand(DISCOVERY_URI,
+                             {'api': 'gmail', 'apiVersion': 'v1'}),
+          discovery_cache.get_static_doc('gmail', 'v1'))
+    report('service, cached', timeRuns(service, runs))
+  finally:
+    shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+  main(runs)
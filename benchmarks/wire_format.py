@@ -0,0 +1,74 @@
+#!/usr/bin/python
+'''
+Compare the size and decode time of a page of the message list when it is
+sent as pickled MessageInfo objects (the old format) and when it is sent with
+encodeMessages.
+
+Run with:
+
+    python -m benchmarks.wire_format [number of messages] [page height]
+
+The messages live in an in memory database, the real one is not touched.
+'''
+
+# ---> Imports
+import pickle
+import sys
+from timeit import timeit
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from pmail.common import (Base, MessageInfo, Labels, encodeMessages,
+                          decodeMessages)
+# <---
+
+ACCOUNT = 'someone@gmail.com'
+LABELS = ['INBOX', 'UNREAD', 'IMPORTANT', 'CATEGORY_PERSONAL', 'Label_12']
+
+
+def mkSession(numOfMessages):
+  engine = create_engine('sqlite://')
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine, expire_on_commit=False)()
+  for i in range(numOfMessages):
+    messageId = '{:016x}'.format(0x170000000000 + i)
+    session.add(MessageInfo(
+        messageId, ACCOUNT, str(1000 + i), str(1590000000000 + i * 60000),
+        12345 + i, 'A snippet of the message, about a hundred characters ' +
+        'long, which is what gmail usually sends.', '<{}@mail>'.format(i),
+        'Subject number {}'.format(i), 'Some Body <somebody@example.com>',
+        None, None, None, ACCOUNT + ', other@example.com', 'text/plain'))
+    session.add_all([Labels(messageId, label)
+                     for label in LABELS[:2 + i % 4]])
+  session.commit()
+  return session
+
+
+def main(numOfMessages, height):
+  session = mkSession(numOfMessages)
+  page = session.query(MessageInfo)\
+      .order_by(MessageInfo.time.desc())\
+      .limit(height).all()
+  number = 200
+
+  old = pickle.dumps(page)
+  new = pickle.dumps(encodeMessages(page))
+  oldTime = timeit(lambda: pickle.loads(old), number=number) / number
+  newTime = timeit(lambda: decodeMessages(pickle.loads(new)),
+                   number=number) / number
+  encodeTime = timeit(lambda: pickle.dumps(encodeMessages(page)),
+                      number=number) / number
+  pickleTime = timeit(lambda: pickle.dumps(page), number=number) / number
+
+  print('Page of {} messages.'.format(len(page)))
+  print('{:<24}{:>12}{:>14}{:>14}'.format('', 'bytes', 'encode (ms)',
+                                          'decode (ms)'))
+  print('{:<24}{:>12}{:>14.3f}{:>14.3f}'.format(
+      'pickled MessageInfo', len(old), pickleTime * 1000, oldTime * 1000))
+  print('{:<24}{:>12}{:>14.3f}{:>14.3f}'.format(
+      'encodeMessages', len(new), encodeTime * 1000, newTime * 1000))
+
+
+if __name__ == '__main__':
+  numOfMessages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  height = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+  main(numOfMessages, height)
@@ -2,10 +2,9 @@ import argparse
 import textwrap
 import os
 import sys
+import pmail
 from pmail.common import config, WORKING_DIR
 from shutil import copyfile
-import pmail.client
-import pmail.server
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(
@@ -74,11 +73,14 @@ if pmail is run with BOTH of -m and -n flags then it will exit with a warning
     raise argparse.ArgumentTypeError(msg)
   elif args.n:
     # print(account)
+    import pmail.server
     pmail.server.checkForNewMessages(args.n)
     # print(args.n)
   elif args.m == 'client':
+    import pmail.client
     pmail.client.start()
   elif args.m == 'server':
+    import pmail.server
     pmail.server.start()
   # elif args.t == 'attach':
   #   pmail.common.setupAttachments('o.g.sargent@gmail.com')
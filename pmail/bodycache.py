@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+# ---> Imports
+import base64
+import os
+import zlib
+from collections import OrderedDict
+from threading import Thread, Lock, Condition, Event, get_ident
+from pmail.common import mkService, logger
+from pmail.quota import execute
+# <---
+
+# ---> Body cache
+'''
+The raw (RFC 822) bodies of messages are kept in a directory, one zlib
+compressed file per message, so that opening a message does not need a
+round trip to gmail. The server owns the cache: clients ask for bodies with
+GET_BODY and tell the server which messages they are likely to open next
+with PREFETCH_BODIES.
+'''
+
+
+def downloadBody(account, messageId):
+  '''
+  Get the raw body of a message from gmail.
+
+  Returns:
+    bytes
+  '''
+  msg = execute(mkService(account).users().messages().get(
+      userId='me', id=messageId, format='raw'))
+  return base64.urlsafe_b64decode(msg['raw'])
+
+
+class BodyCache():
+  '''
+  Size bounded, least recently used bodies are evicted first. Recency
+  survives restarts as the modification time of the files.
+  '''
+
+  def __init__(self, directory, maxSize):
+    self.directory = directory
+    self.maxSize = maxSize
+    self.lock = Lock()
+    # messageId -> size on disk, least recently used first.
+    self.entries = OrderedDict()
+    self.size = 0
+    # messageId -> Event, for bodies which are being downloaded.
+    self.fetching = {}
+    # (account, messageId) pairs waiting to be prefetched.
+    self.wanted = []
+    self.wantedChanged = Condition()
+    # Called as onPut(messageId, raw) when a body is added, e.g. to index it.
+    self.onPut = None
+
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    for name in os.listdir(directory):
+      if name.endswith('.z'):
+        stat = os.stat(os.path.join(directory, name))
+        files.append((stat.st_mtime, name[:-2], stat.st_size))
+    for (_, messageId, size) in sorted(files):
+      self.entries[messageId] = size
+      self.size += size
+    Thread(target=self._prefetcher, daemon=True).start()
+
+  def _path(self, messageId):
+    return os.path.join(self.directory, messageId + '.z')
+
+  def get(self, messageId):
+    '''
+    Get a body from the cache.
+
+    Returns:
+      bytes or None if the body is not cached.
+    '''
+    with self.lock:
+      if messageId not in self.entries:
+        return None
+      self.entries.move_to_end(messageId)
+    try:
+      path = self._path(messageId)
+      with open(path, 'rb') as f:
+        raw = zlib.decompress(f.read())
+      os.utime(path)
+      return raw
+    except (OSError, zlib.error):
+      logger.exception('Could not read {} from the body cache.'
+                       .format(messageId))
+      self.remove([messageId])
+      return None
+
+  def put(self, messageId, raw):
+    '''
+    Add a body to the cache, evicting old ones to make room.
+    '''
+    data = zlib.compress(raw)
+    path = self._path(messageId)
+    tmpPath = '{}.{}.tmp'.format(path, get_ident())
+    with open(tmpPath, 'wb') as f:
+      f.write(data)
+    os.replace(tmpPath, path)
+    with self.lock:
+      self.size += len(data) - self.entries.pop(messageId, 0)
+      self.entries[messageId] = len(data)
+      evicted = []
+      while self.size > self.maxSize and len(self.entries) > 1:
+        oldId, size = self.entries.popitem(last=False)
+        self.size -= size
+        evicted.append(oldId)
+    for oldId in evicted:
+      try:
+        os.remove(self._path(oldId))
+      except OSError:
+        pass
+    if self.onPut:
+      try:
+        self.onPut(messageId, raw)
+      except Exception:
+        logger.exception('onPut failed for {}.'.format(messageId))
+
+  def remove(self, messageIds):
+    '''
+    Drop bodies from the cache.
+    '''
+    with self.lock:
+      removed = [m for m in messageIds if m in self.entries]
+      for messageId in removed:
+        self.size -= self.entries.pop(messageId)
+    for messageId in removed:
+      try:
+        os.remove(self._path(messageId))
+      except OSError:
+        pass
+
+  def fetch(self, account, messageId):
+    '''
+    Get a body, from the cache if possible, otherwise from gmail. If the
+    body is already being downloaded, e.g. by the prefetcher, wait for that
+    rather than downloading it twice.
+
+    Returns:
+      bytes
+    '''
+    while 1:
+      raw = self.get(messageId)
+      if raw is not None:
+        return raw
+      with self.lock:
+        done = self.fetching.get(messageId)
+        if done is None:
+          done = self.fetching[messageId] = Event()
+          break
+      # Somebody else is downloading it, wait and then look again.
+      done.wait()
+    try:
+      raw = downloadBody(account, messageId)
+      self.put(messageId, raw)
+      return raw
+    finally:
+      with self.lock:
+        self.fetching.pop(messageId, None)
+      done.set()
+
+  def prefetch(self, messages):
+    '''
+    Replace the list of messages to prefetch, the most wanted first.
+
+    Args:
+      messages: List of (account, messageId) pairs.
+    '''
+    with self.wantedChanged:
+      self.wanted = [(a, m) for (a, m) in messages if m not in self.entries]
+      self.wantedChanged.notify()
+
+  def _prefetcher(self):
+    while 1:
+      with self.wantedChanged:
+        while not self.wanted:
+          self.wantedChanged.wait()
+        account, messageId = self.wanted.pop(0)
+      try:
+        self.fetch(account, messageId)
+      except Exception:
+        logger.exception('Could not prefetch {}.'.format(messageId))
+
+  def patch(self, session, change, data):
+    '''
+    Change listener, see pmail.common.addChangeListener. Drops the bodies
+    of messages which were deleted.
+    '''
+    if change == 'MESSAGES_REMOVED':
+      self.remove(data)
+
+# <---
+
+"""
+vim:foldmethod=marker foldmarker=--->,<---
+"""
@@ -7,21 +7,26 @@ import email
 import errno
 import os
 import sys
-import pickle
 import re
 import socket
+import tempfile
 # import logging
 
 # from apiclient import errors
-from pmail.common import (mkService, MessageInfo, Attachments,
+from pmail.common import (mkService, MessageInfo,
                           listMessagesMatchingQuery, logger,
-                          AddressBook, config)
+                          AddressBook, config, decodeMessages,
+                          getCredentials, MessageSearch)
 # from itertools import cycle
 from pmail.sendmail import (sendMessage, mkSubject, mkTo, createMessage)
+from pmail.protocol import recvFrame, encodeFrame, ServerError
+from pmail import quota
+from pmail.quota import execute
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from subprocess import run, PIPE, Popen
 from threading import Thread, Event, Lock
 from uuid import uuid4
-from time import sleep
 from queue import Queue
 from shutil import which
 # <---
@@ -55,7 +60,7 @@ class State():
     self.event = kwargs.get('event', None)
     # Any search terms in effect.
     self.searchTerms = kwargs.get('searchTerms', None)
-    # A list of messageIds resulting from a search
+    # The handle of the results of a search, kept by the server.
     self.query = kwargs.get('query', None)
     # A list of selected messageIds.
     self.selectedMessages = kwargs.get('selectedMessages', [])
@@ -67,6 +72,10 @@ class State():
     self.newMessagesArrived = kwargs.get('newMessagesArrived', None)
     # Thread for handling keypress.
     self.keyHandler = kwargs.get('keyHandler', None)
+    # The messages whose bodies the server was last asked to prefetch.
+    self.prefetched = kwargs.get('prefetched', [])
+    # account -> the last SyncProgress event, while an account is syncing.
+    self.syncProgress = kwargs.get('syncProgress', {})
 
   def read(self, messageId, message):
     '''
@@ -179,10 +188,7 @@ class State():
     '''
     Method to view attachements.
     '''
-    attachments = getAttachments(
-        mkService(self.selectedMessages[0].emailAddress),
-        self.selectedMessages[0],
-        self.globalLock)
+    attachments = getAttachments(self.selectedMessages[0], self.globalLock)
     if attachments:
       self.action = ViewAttachments(attachments)
       return True
@@ -314,7 +320,10 @@ class State():
                   mbLen + n + labelsLen, whitespace)
     stdscr.attroff(curses.color_pair(5))
 
-    if numOfMessages > 0:
+    status = downloads.status() or self.syncStatus()
+    if status:
+      putMessage(stdscr, height, width, status)
+    elif numOfMessages > 0:
       snippet = ' On {} <{}> wrote: {} {}'.format(
           selectedMessage.timeForReply(),
           selectedMessage.parseSender()[0],
@@ -326,6 +335,21 @@ class State():
       except curses.error:
         stdscr.addstr(height - 1, 0, ' ' * (width - 1))
 
+  def syncStatus(self):
+    '''
+    Returns:
+      A line for the status bar about accounts which are being synced, or
+      None if there are none.
+    '''
+    if not self.syncProgress:
+      return None
+    return ' '.join(
+        'Syncing {}: {}/{} messages, {:.0f}/s{}.'.format(
+            p['account'], p['fetched'], p['total'], p['rate'],
+            ', about {} left'.format(duration(p['eta']))
+            if p['eta'] is not None else '')
+        for p in self.syncProgress.values())
+
 # <---
 
 # <---
@@ -514,8 +538,10 @@ class ViewAttachments(Action):
 
   def perform(self, state):
     # do something here and return something depending on if succesful or not
+    account = state.account if state.account else\
+        state.selectedMessages[0].emailAddress
     curses.wrapper(lambda x: drawAttachments(
-        x, state.account, state, self.attachments))
+        x, account, state, self.attachments))
 
 
 class Quit(Action):
@@ -791,6 +817,7 @@ def drawAttachments(stdscr, account, state, attachments):
   '''
   k = 0
   cursor_y = 0
+  selected = []
   # Clear and refresh the screen for a blank canvas
   # Start colors in curses
   curses.curs_set(0)
@@ -814,9 +841,19 @@ def drawAttachments(stdscr, account, state, attachments):
     elif k in [curses.KEY_UP, ord('k')]:
       cursor_y = cursor_y - 1
 
+    elif k == ord(' '):
+      # Select attachment.
+      if selectedAttachment not in selected:
+        selected.append(selectedAttachment)
+      else:
+        selected.remove(selectedAttachment)
+      k = curses.KEY_DOWN
+      continue
+
     elif k == ord('s'):
-      # Try to save selectedAttachment.
-      saveAttachment(mkService(account), selectedAttachment)
+      # Save the selected attachments, or the highlighted one, in the
+      # background.
+      downloads.save(account, selected or [selectedAttachment])
       state.action.saved = 'SAVED_ATTACHMENT'
       return state
 
@@ -833,7 +870,15 @@ def drawAttachments(stdscr, account, state, attachments):
       display = a.display()
       l1 = len(display)
       stdscr.attron(curses.color_pair(1))
-      if cursor_y == i:
+      if cursor_y == i and a in selected:
+        stdscr.attron(curses.color_pair(4))
+        stdscr.attron(curses.A_BOLD)
+        stdscr.addstr(i, 0, display)
+        if (width - l1) > 0:
+          stdscr.addstr(i, l1, " " * (width - l1))
+        stdscr.attroff(curses.A_BOLD)
+        stdscr.attroff(curses.color_pair(4))
+      elif cursor_y == i:
         stdscr.attron(curses.color_pair(3))
         stdscr.attron(curses.A_BOLD)
         stdscr.addstr(i, 0, display)
@@ -841,6 +886,14 @@ def drawAttachments(stdscr, account, state, attachments):
           stdscr.addstr(i, l1, " " * (width - l1))
         stdscr.attroff(curses.A_BOLD)
         stdscr.attroff(curses.color_pair(3))
+      elif a in selected:
+        stdscr.attron(curses.color_pair(2))
+        stdscr.attron(curses.A_BOLD)
+        stdscr.addstr(i, 0, display)
+        if (width - l1) > 0:
+          stdscr.addstr(i, l1, " " * (width - l1))
+        stdscr.attroff(curses.A_BOLD)
+        stdscr.attroff(curses.color_pair(2))
       else:
         stdscr.addstr(i, 0, display)
         if (width - l1) > 0:
@@ -870,7 +923,8 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
     state: The state of the program.
     accountSwitcher: n-cycle to cycle through accounts where n is the number
     of accounts.
-    eventQue: A Queue which will contain events when new messages show up.
+    eventQue: A Queue which will contain keypresses and events pushed by the
+    server, e.g. when new messages show up.
 
   Returns:
     State()
@@ -897,11 +951,7 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
   state.height = height
 
   # Update the list of messages.
-  messages = getMessages(state, returnCount=False)
-  # if state.thread:
-  #   if state.thread.name == "postRead":
-  #     logger.info('Getting new message list.')
-  numOfMessages = getMessages(state, returnCount=True)
+  messages, numOfMessages = getPage(state)
   try:
     selectedMessage = messages[state.cursor_y]
   except IndexError:
@@ -967,8 +1017,8 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
       # Read a message.
       account = state.account if state.account else\
           selectedMessage.emailAddress
-      message = readMessage(mkService(account),
-                            selectedMessage.messageId)
+      message = readMessage(account, selectedMessage.messageId,
+                            state.globalLock)
       state.selectedMessages = [selectedMessage]
       state.read(selectedMessage.messageId, message)
       return state
@@ -977,9 +1027,10 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
       # Reply to message.
       account = state.account if state.account else\
           selectedMessage.emailAddress
-      message = readMessage(mkService(account),
-                            selectedMessage.messageId)
-      state.reply(selectedMessage, message)
+      message = readMessage(account, selectedMessage.messageId,
+                            state.globalLock)
+      state.reply(getMessageInfo(selectedMessage, state.globalLock),
+                  message)
       stdscr.addstr(height - 1, 0, ' ' * (width - 1))
       curses.curs_set(0)
       return state
@@ -990,9 +1041,10 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
           selectedMessage.emailAddress
       to = chooseAddress(account)
       if to:
-        message = readMessage(mkService(account),
-                              selectedMessage.messageId)
-        state.forward(selectedMessage, message, to)
+        message = readMessage(account, selectedMessage.messageId,
+                              state.globalLock)
+        state.forward(
+            getMessageInfo(selectedMessage, state.globalLock), message, to)
         stdscr.addstr(height - 1, 0, ' ' * (width - 1))
         curses.curs_set(0)
         return state
@@ -1001,9 +1053,10 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
       # Reply to group/all.
       account = state.account if state.account else\
           selectedMessage.emailAddress
-      message = readMessage(mkService(account),
-                            selectedMessage.messageId)
-      state.replyToAll(selectedMessage, message)
+      message = readMessage(account, selectedMessage.messageId,
+                            state.globalLock)
+      state.replyToAll(
+          getMessageInfo(selectedMessage, state.globalLock), message)
       stdscr.addstr(height - 1, 0, ' ' * (width - 1))
       curses.curs_set(0)
       return state
@@ -1053,11 +1106,7 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
         # Add to TRASH but don't read.
         state.trash().act()
 
-      messages = getMessages(state, returnCount=False, afterAction={
-          'action': state.action.type,
-          'messageIds': [m.messageId for m in state.selectedMessages]
-      })
-      numOfMessages = getMessages(state, returnCount=True)
+      messages, numOfMessages = getPage(state)
       state.selectedMessages = []
 
     elif k == ord('l'):
@@ -1084,24 +1133,21 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
           state.excludedLabels = ['SPAM']
           state.includedLabels = ['TRASH']
         state.position = 0
-        messages = getMessages(state, returnCount=False)
-        numOfMessages = getMessages(state, returnCount=True)
+        messages, numOfMessages = getPage(state)
 
     elif k == ord('/'):
       # Do a search.
       searchTerms = getInput(stdscr, "Enter search terms: ", height, width)
       if searchTerms:
         state.addQuery(searchTerms)
-        messages = getMessages(state, returnCount=False)
-        numOfMessages = getMessages(state, returnCount=True)
+        messages, numOfMessages = getPage(state)
       curses.curs_set(0)
 
     elif k == ord('c'):
       # Clear search terms.
       if state.searchTerms:
         state.addQuery(None)
-        messages = getMessages(state, returnCount=False)
-        numOfMessages = getMessages(state, returnCount=True)
+        messages, numOfMessages = getPage(state)
       curses.curs_set(0)
 
     elif k == ord('v'):
@@ -1123,8 +1169,7 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
     elif k == ord('\t'):
       # Toggle between accounts.
       state.switchAccount(accountSwitcher.next())
-      messages = getMessages(state, returnCount=False)
-      numOfMessages = getMessages(state, returnCount=True)
+      messages, numOfMessages = getPage(state)
 
     elif k == ord('b'):
       # Switch between accounts by index.
@@ -1134,13 +1179,11 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
           account = accountSwitcher.switch(i - 1)
           if account:
             state.switchAccount(account)
-            messages = getMessages(state, returnCount=False)
-            numOfMessages = getMessages(state, returnCount=True)
+            messages, numOfMessages = getPage(state)
       if k == ord('u'):
         # Unified mailbox
         state.switchAccount(None)
-        messages = getMessages(state, returnCount=False)
-        numOfMessages = getMessages(state, returnCount=True)
+        messages, numOfMessages = getPage(state)
 
     elif k == ord('q'):
       # Quit.
@@ -1167,6 +1210,7 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
       except Exception:
         logger.exception('Caught error trying to select a message.')
       # state.selectedMessage = selectedMessage
+      prefetchBodies(state, messages, selectedMessage)
 
       for i, h in enumerate(messages[:height - 2]):
         display = h.display(15, width, labelMap)
@@ -1211,8 +1255,8 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
     if (state.action and
         state.action.action == 'VIEW_ATTACHMENTS' and
             state.action.saved == 'SAVED_ATTACHMENT'):
-      # if state['action'] == 'SAVED_ATTACHMENT':
-      putMessage(stdscr, height, width, "Attachment saved successfully.")
+      # Saving happens in the background, the status bar shows how it is
+      # going.
       state.action = None
       state.selectedMessages = []
 
@@ -1247,10 +1291,20 @@ def drawMessages(stdscr, state, accountSwitcher, eventQue, labelMap):
 
     if e['event'] == 'KeyPress':
       k = e['value']
-    elif e['event'] == 'NewMsg':
+    elif e['event'] in ['NewMsg', 'LabelsChanged']:
       logger.info('Redrawing message list')
-      messages = getMessages(state, returnCount=False)
+      messages, numOfMessages = getPage(state)
+      k = None
+    elif e['event'] == 'Download':
       k = None
+    elif e['event'] == 'SyncProgress':
+      if e['done']:
+        state.syncProgress.pop(e['account'], None)
+      else:
+        state.syncProgress[e['account']] = e
+      k = None
+    elif e['event'] == 'Disconnected':
+      raise ConnectionError('Lost the connection to the server.')
 
 # <---
 
@@ -1290,8 +1344,8 @@ def postDelete(state, service, messages):
                 'removeLabelIds': [],
                 'addLabelIds': ['TRASH']}
       try:
-        service(account).users().messages().batchModify(
-            userId='me', body=body).execute()
+        execute(service(account).users().messages().batchModify(
+            userId='me', body=body))
       except Exception:
         logger.exception(
             'Something went wrong trying to delete from remote server.'
@@ -1377,14 +1431,7 @@ def postRead(service, state):
   messageId = state.selectedMessages[0].messageId
   lock = state.globalLock
   data = {'action': 'REMOVE_LABELS',
-          'labels': [(messageId, ['UNREAD'])],
-          'account': account,
-          'query': state.query,
-          'position': state.position,
-          'height': state.height,
-          'excludedLabels': state.excludedLabels,
-          'includedLabels': state.includedLabels,
-          'afterAction': 'MARK_AS_READ'}
+          'labels': [(messageId, ['UNREAD'])]}
   response = sendToServer(data, lock)
   logger.info('Response from server: {}'.format(response))
   # logger.info('Data successfully sent to server.')
@@ -1395,8 +1442,8 @@ def postRead(service, state):
   # logger.info('Removing label from Google servers.')
   body = {'removeLabelIds': ['UNREAD'], 'addLabelIds': []}
   try:
-    service(account).users().messages().modify(userId='me', id=messageId,
-                                               body=body).execute()
+    execute(service(account).users().messages().modify(
+        userId='me', id=messageId, body=body))
   except Exception:
     logger.exception('Caught an error while reading mail.')
 
@@ -1405,25 +1452,57 @@ def postRead(service, state):
 # ---> Preprocessing
 
 
-def readMessage(service, messageId):
+def readMessage(account, messageId, lock):
   '''
-  Retrive a message from the server ready for reading.
+  Retrive a message ready for reading. The body comes from the server,
+  which keeps a cache of them, see pmail.bodycache.
 
   Args:
-    service: The google API service object.
+    account: The account the message belongs to.
     messageId: The id of the message to retrive.
+    lock: threading.Lock(), passed to sendToServer.
 
   Returns:
     The message as a string ready for w3m.
   '''
-  msg = service.users().messages().get(
-      userId='me', id=messageId, format='raw').execute()
-  msg = msg['raw']
-  msg = base64.urlsafe_b64decode(msg).decode('utf-8')
-  msg = email.message_from_string(msg, policy=email.policy.default)
+  raw = sendToServer({'action': 'GET_BODY',
+                      'account': account,
+                      'messageId': messageId}, lock)
+  msg = email.message_from_bytes(raw, policy=email.policy.default)
   return msg.get_body(('html', 'plain',)).get_content()
 
 
+def prefetchBodies(state, messages, selectedMessage):
+  '''
+  Ask the server to fetch the bodies of the messages which are likely to be
+  read next, i.e. the highlighted one and the next few unread ones, so that
+  they are cached by the time they are opened.
+
+  Args:
+    state: The state of the program.
+    messages: The messages currently on the screen.
+    selectedMessage: The highlighted message.
+
+  Returns:
+    None
+  '''
+  wanted = [selectedMessage]
+  for m in messages[state.cursor_y + 1:]:
+    if len(wanted) > config.bodyPrefetch:
+      break
+    if 'UNREAD' in m.labelIds:
+      wanted.append(m)
+  wanted = [(m.emailAddress, m.messageId) for m in wanted]
+  if wanted == state.prefetched:
+    return
+  state.prefetched = wanted
+  try:
+    sendToServerAsync({'action': 'PREFETCH_BODIES', 'messages': wanted},
+                      state.globalLock)
+  except Exception:
+    logger.exception('Could not ask the server to prefetch bodies.')
+
+
 def addInfo(header, formatedMessage, type):
   '''
   Add a line containing infomation, and indent
@@ -1463,91 +1542,258 @@ def addInfo(header, formatedMessage, type):
 # ---> Processing Attachments
 
 
-def saveAttachment(service, attachment):
+ATTACHMENT_URL = ('https://gmail.googleapis.com/gmail/v1/users/me/messages/'
+                  '{}/attachments/{}')
+# Bytes read from the network at a time while downloading an attachment.
+DOWNLOAD_CHUNK = 64 * 1024
+# Attachments saved at the same time.
+DOWNLOAD_WORKERS = 4
+DATA_FIELD = re.compile(rb'"data"\s*:\s*"')
+
+
+def findPart(payload, partId):
   '''
-  Save an attachement.
+  Find a part of a message, looking inside nested multipart parts.
 
   Args:
-    service: The google API service object.
-    attachment: The attachment object to be saved.
+    payload: The payload of a message, as returned by messages().get.
+    partId: The id of the part.
+
+  Returns:
+    The part or None if there is no such part.
+  '''
+  if payload.get('partId') == partId:
+    return payload
+  for part in payload.get('parts', []):
+    found = findPart(part, partId)
+    if found is not None:
+      return found
+  return None
+
+
+def streamAttachment(account, messageId, attachmentId, f, progress):
+  '''
+  Download an attachment, decoding it and writing it to f as it arrives,
+  so that it is never held in memory all at once. The response is JSON,
+  {"size": ..., "data": "..."}, where data is urlsafe base64, which never
+  needs escaping, so it is enough to look for the start and end of the
+  string.
+
+  Args:
+    account: The account the message belongs to.
+    messageId: The id of the message.
+    attachmentId: The id of the attachment.
+    f: A file opened for writing bytes.
+    progress: Called with the number of bytes written so far.
 
   Returns:
     None
   '''
+  from google.auth.transport.requests import AuthorizedSession
+  session = AuthorizedSession(getCredentials(account))
+  url = ATTACHMENT_URL.format(messageId, attachmentId)
+  for attempt in range(quota.MAX_RETRIES + 1):
+    quota.limiter.acquire(
+        quota.QUOTA_UNITS['gmail.users.messages.attachments.get'])
+    response = session.get(url, stream=True, timeout=60)
+    if response.status_code not in quota.RETRY_STATUSES or \
+       attempt == quota.MAX_RETRIES:
+      break
+    response.close()
+    logger.warning('Downloading attachment failed with {}, retrying.'
+                   .format(response.status_code))
+    quota.backoff(attempt)
+
+  with response:
+    response.raise_for_status()
+    head = b''
+    # Base64 left over from the last chunk, which is not a multiple of 4.
+    pending = None
+    written = 0
+    for chunk in response.iter_content(DOWNLOAD_CHUNK):
+      if pending is None:
+        head += chunk
+        match = DATA_FIELD.search(head)
+        if match is None:
+          continue
+        chunk, pending = head[match.end():], b''
+      end = chunk.find(b'"')
+      data = pending + (chunk if end == -1 else chunk[:end])
+      n = len(data) // 4 * 4
+      written += f.write(base64.urlsafe_b64decode(data[:n]))
+      pending = data[n:]
+      progress(written)
+      if end != -1:
+        break
+    if pending is None:
+      raise ValueError('No data in response for attachment {}.'
+                       .format(attachmentId))
+    if pending:
+      written += f.write(base64.urlsafe_b64decode(
+          pending + b'=' * (-len(pending) % 4)))
+      progress(written)
+
+
+def saveAttachment(account, attachment, progress=lambda written: None):
+  '''
+  Save an attachement to the download directory. It is written to a
+  temporary file first, and only renamed when it is complete.
+
+  Args:
+    account: The account the message belongs to.
+    attachment: The attachment object to be saved.
+    progress: Called with the number of bytes written so far.
+
+  Returns:
+    The path of the saved file.
+  '''
   messageId = attachment.messageId
+  message = execute(mkService(account).users().messages().get(
+      userId='me', id=messageId, fields='payload'))
+  part = findPart(message['payload'], attachment.partId)
+  if part is None:
+    raise ValueError('Message {} has no part {}.'
+                     .format(messageId, attachment.partId))
+
+  filename = os.path.basename(part['filename']) or attachment.partId
+  path = os.path.join(config.dlDir, filename)
+  fd, tmpPath = tempfile.mkstemp(dir=config.dlDir, prefix='.' + filename,
+                                 suffix='.part')
   try:
-    message = service.users().messages().get(userId='me',
-                                             id=messageId).execute()
+    with os.fdopen(fd, 'wb') as f:
+      if 'data' in part['body']:
+        # Small attachments come with the message.
+        progress(f.write(base64.urlsafe_b64decode(
+            part['body']['data'].encode('utf-8'))))
+      else:
+        streamAttachment(account, messageId, part['body']['attachmentId'],
+                         f, progress)
+    os.replace(tmpPath, path)
+  except BaseException:
+    os.remove(tmpPath)
+    raise
+  return path
 
-    for part in message['payload']['parts']:
-      if part['filename']:
-        if part['partId'] == attachment.partId:
 
-          if 'data' in part['body']:
-            data = base64.urlsafe_b64decode(part['body']['data']
-                                            .encode('utf-8'))
-          else:
-            attachmentId = part['body']['attachmentId']
-            a = service.users().messages().attachments()\
-                .get(userId='me', id=attachmentId, messageId=messageId)\
-                .execute()
-            data = base64.urlsafe_b64decode(a['data'].
-                                            encode('utf-8'))
+class Downloads():
+  '''
+  Attachments being saved in the background. Their progress is shown in the
+  status bar, which is redrawn by putting a Download event in onEvent.
+  '''
 
-          path = os.path.join(config.dlDir, part['filename'])
+  def __init__(self):
+    self.pool = None
+    self.lock = Lock()
+    # (messageId, partId) -> [filename, bytes written, size]
+    self.progress = {}
+    # Messages about finished downloads, not yet shown.
+    self.finished = []
+    self.onEvent = None
+
+  def save(self, account, attachments):
+    '''
+    Start saving some attachments, they are saved in parallel.
 
-          with open(path, 'wb') as f:
-            f.write(data)
+    Args:
+      account: The account the attachments belong to.
+      attachments: A list of attachment objects.
+
+    Returns:
+      None
+    '''
+    with self.lock:
+      if self.pool is None:
+        self.pool = ThreadPoolExecutor(DOWNLOAD_WORKERS)
+      for a in attachments:
+        key = (a.messageId, a.partId)
+        if key not in self.progress:
+          self.progress[key] = [a.filename, 0, a.size]
+          self.pool.submit(self._save, account, a)
+    self._notify()
+
+  def _save(self, account, attachment):
+    key = (attachment.messageId, attachment.partId)
+
+    def progress(written):
+      with self.lock:
+        entry = self.progress[key]
+        before = percent(entry[1], entry[2])
+        entry[1] = written
+        changed = percent(written, entry[2]) != before
+      if changed:
+        self._notify()
+
+    try:
+      path = saveAttachment(account, attachment, progress)
+      message = 'Saved {}.'.format(path)
+    except Exception:
+      logger.exception('An error occured while tring to save an attachment.')
+      message = 'Could not save {}.'.format(attachment.filename)
+    with self.lock:
+      del self.progress[key]
+      self.finished.append(message)
+    self._notify()
+
+  def _notify(self):
+    if self.onEvent:
+      self.onEvent({'event': 'Download'})
+
+  def status(self):
+    '''
+    Returns:
+      A line for the status bar, or None if there is nothing to show.
+    '''
+    with self.lock:
+      if self.progress:
+        return 'Saving ' + ', '.join(
+            '{} {}%'.format(filename, percent(written, size))
+            for (filename, written, size) in self.progress.values())
+      message, self.finished = ' '.join(self.finished), []
+      return message or None
+
+
+def percent(written, size):
+  return min(100, written * 100 // size) if size else 100
+
+
+def duration(seconds):
+  '''
+  Returns:
+    seconds as e.g. '45s', '12m' or '3h 20m'.
+  '''
+  seconds = int(seconds)
+  if seconds < 60:
+    return '{}s'.format(seconds)
+  if seconds < 60 * 60:
+    return '{}m'.format(seconds // 60)
+  return '{}h {}m'.format(seconds // 3600, seconds % 3600 // 60)
 
-  except Exception:
-    logger.exception('An error occured while tring to save an attachment.')
-    # logger.warning('An error occurred: {}'.format(e))
 
+downloads = Downloads()
 
-def getAttachments(service, header, lock):
+
+def getAttachments(header, lock):
   '''
   Get a list of attachements, if any, from the highlighted message.
 
   Args:
-    service: The google API service.
     header: The MessageInfo object corresponding to the highlighted
     message.
+    lock: threading.Lock(), passed to sendToServer.
 
   Returns:
     List of attachment objects or None if there are no attachments.
   '''
-  messageId = header.messageId
-  attachments = []
-  data = {'action': 'GET_QUERY',
-          'class': Attachments,
-          'messageIds': [messageId]}
-  q = sendToServer(data, lock)
-  # q = s.query(Attachments).filter(Attachments.messageId == messageId)
-  if len(q) > 0:
-    # Attachment info exists in db - use this.
-    attachments = q
-  else:
-    # Fetch attachment info.
-    try:
-      message = service.users().messages().get(userId='me',
-                                               id=messageId).execute()
-
-      for part in message['payload']['parts']:
-        if part['filename']:
-          a = Attachments(
-              messageId,
-              part['partId'],
-              part['filename'],
-              part['mimeType'],
-              part['body']['size'])
-          # s.add(a)
-          data = {'action': 'ADD_ATTACHMENT',
-                  'attachment': a}
-          sendToServer(data, lock)
-          attachments.append(a)
-
-    except Exception:
-      logger.exception('An error occurred while getting attachments.')
+  data = {'action': 'GET_ATTACHMENTS',
+          'account': header.emailAddress,
+          'messageId': header.messageId}
+  try:
+    attachments = sendToServer(data, lock)
+  except ConnectionError:
+    raise
+  except Exception:
+    logger.exception('An error occurred while getting attachments.')
+    attachments = []
   if len(attachments) == 0:
     logger.info('Trying to view attachments but there are none')
   else:
@@ -1561,26 +1807,44 @@ def getAttachments(service, header, lock):
 
 def search(account, searchTerms, lock):
   '''
-  Do a search.
+  Do a search. The server answers it from its index, or from an earlier
+  identical search, when it can. Otherwise gmail is asked, the messages
+  found are added to the db, and sent to the server with the search. With
+  config.searchGmail gmail is also asked about messages older than
+  config.syncFrom, which are not in the index.
 
   Args:
-    account: Currently selected account.
+    account: Currently selected account, None for all accounts.
     searchTerms: What to search for.
 
   Returns:
-    query consiting of MessageInfo objects.
+    The handle of the results, which are kept by the server.
   '''
-  service = mkService(account)
-  messageIds = [m['id'] for m in
-                listMessagesMatchingQuery(service, 'me', query=searchTerms)]
-  data = {'action': 'ADD_MESSAGES',
+  data = {'action': 'SEARCH',
           'account': account,
-          'messageIds': messageIds}
-  sendToServer(data, lock)
-  data = {'action': 'GET_QUERY',
-          'class': MessageInfo,
-          'messageIds': messageIds}
-  return [q.messageId for q in sendToServer(data, lock)]
+          'searchTerms': searchTerms}
+  handle = sendToServer(data, lock)
+  if handle is not None:
+    return handle
+
+  if MessageSearch.canSearch(searchTerms):
+    gmailTerms = '{} older_than:{}'.format(searchTerms, config.syncFrom)
+  else:
+    gmailTerms = searchTerms
+  found = []
+  for a in [account] if account else list(config.listAccounts()):
+    ids = [m['id'] for m in listMessagesMatchingQuery(
+        mkService(a), 'me', query=gmailTerms) or []]
+    data = {'action': 'ADD_MESSAGES',
+            'account': a,
+            'messageIds': ids}
+    sendToServer(data, lock)
+    found += ids
+  data = {'action': 'SEARCH',
+          'account': account,
+          'searchTerms': searchTerms,
+          'messageIds': found}
+  return sendToServer(data, lock)
 
 
 def listFiles(directory):
@@ -1668,50 +1932,161 @@ def fzf(prompt, iterable):
 # ---> Main
 
 
-def sendToServer(data, lock):
+class PendingResponse():
+  '''
+  A response which the server has not sent yet.
   '''
-  Function to send data to the server.
 
-  Args:
-    data: What ever we should send to the server.
-    lock: threading.Lock().
+  def __init__(self):
+    self.event = Event()
+    self.response = None
+    self.error = None
 
-  Returns:
-    A response from the server (possibly None).
+  def set(self, frame):
+    self.response = frame.get('response')
+    self.error = frame.get('error')
+    self.event.set()
+
+  def fail(self, error):
+    self.error = error
+    self.event.set()
 
+  def result(self):
+    '''
+    Wait for the response to arrive and return it.
+    '''
+    self.event.wait()
+    if isinstance(self.error, Exception):
+      raise self.error
+    elif self.error:
+      raise ServerError(self.error)
+    return self.response
+
+
+class ServerConnection():
   '''
-  with lock:
-    host = socket.gethostname()
-    port = config.port
-    sock = socket.socket()
-    bufferSize = 1024
+  One connection to the server which is kept open for the whole lifetime of
+  the client. Every request is tagged with a requestId, a reader thread hands
+  each response to whoever is waiting for it, so several requests can be
+  pipelined on the connection.
+  '''
+
+  def __init__(self):
+    self.sock = None
+    # Called with events which the server pushes to us.
+    self.onEvent = None
+    self.sendLock = Lock()
+    self.pendingLock = Lock()
+    self.pending = {}
+    self.requestIds = count()
+
+  def isConnected(self):
+    return self.sock is not None
+
+  def connect(self):
+    if config.transport == 'unix':
+      sock = socket.socket(socket.AF_UNIX)
+      sock.connect(config.socketPath)
+    else:
+      sock = socket.socket()
+      sock.connect((socket.gethostname(), config.port))
+    self.sock = sock
+    Thread(target=self._read, args=(sock,), name='serverReader',
+           daemon=True).start()
+
+  def submit(self, data):
+    '''
+    Send a request without waiting for the response.
 
+    Args:
+      data: What ever we should send to the server.
+
+    Returns:
+      PendingResponse()
+    '''
+    requestId = next(self.requestIds)
+    pending = PendingResponse()
+    with self.pendingLock:
+      self.pending[requestId] = pending
+    frame = encodeFrame(dict(data, requestId=requestId))
+    try:
+      with self.sendLock:
+        self.sock.sendall(frame)
+    except (OSError, AttributeError) as e:
+      with self.pendingLock:
+        self.pending.pop(requestId, None)
+      raise ConnectionError('Could not send to server.') from e
+    return pending
+
+  def _read(self, sock):
+    '''
+    Read responses from the server until the connection closes.
+    '''
     try:
-      sock.connect((host, port))
-      pickledData = pickle.dumps(data)
-      sizeOfPickle = len(pickledData)
-      numOfChunks = sizeOfPickle // bufferSize + 1
-      sock.send(sizeOfPickle.to_bytes(4, 'big'))
+      while 1:
+        frame = recvFrame(sock)
+        if frame['requestId'] is None:
+          # Something pushed by the server, not a response.
+          if self.onEvent:
+            frame.pop('requestId')
+            self.onEvent(frame)
+          continue
+        with self.pendingLock:
+          pending = self.pending.pop(frame['requestId'], None)
+        if pending:
+          pending.set(frame)
+    except (ConnectionError, OSError):
+      logger.warning('Lost the connection to the server.')
+      if self.onEvent:
+        self.onEvent({'event': 'Disconnected'})
+    finally:
+      self.sock = None
+      sock.close()
+      with self.pendingLock:
+        pending, self.pending = self.pending, {}
+      for p in pending.values():
+        p.fail(ConnectionError('Lost the connection to the server.'))
 
-      for i in range(numOfChunks):
-        sock.send(pickledData[i * bufferSize: (i + 1) * bufferSize])
 
-      sizeOfResponse = int.from_bytes(sock.recv(4), 'big')
-      response = b''
+connection = ServerConnection()
 
-      while len(response) < sizeOfResponse:
-        response += sock.recv(bufferSize)
 
-      unpickledResponse = pickle.loads(response)
-      sock.close()
-      return unpickledResponse
+def sendToServerAsync(data, lock):
+  '''
+  Function to send data to the server without waiting for the response.
 
-    except ConnectionError:
-      raise
+  Args:
+    data: What ever we should send to the server.
+    lock: threading.Lock(), held while connecting to the server.
 
-    except Exception:
-      logger.warning('There was an error while trying to send to server.')
-      raise
+  Returns:
+    PendingResponse(), call result() on it to get the response.
+  '''
+  with lock:
+    if not connection.isConnected():
+      connection.connect()
+  try:
+    return connection.submit(data)
+  except ConnectionError:
+    raise
+  except Exception:
+    logger.warning('There was an error while trying to send to server.')
+    raise
+
+
+def sendToServer(data, lock):
+  '''
+  Function to send data to the server.
+
+  Args:
+    data: What ever we should send to the server.
+    lock: threading.Lock(), held while connecting to the server.
+
+  Returns:
+    A response from the server (possibly None).
+
+  '''
+  return sendToServerAsync(data, lock).result()
 
 
 def setEscDelay():
@@ -1722,6 +2097,17 @@ def setEscDelay():
   os.environ.setdefault('ESCDELAY', '25')
 
 
+def _getMessagesData(state, returnCount):
+  return {'action': 'GET_MESSAGES',
+          'account': state.account,
+          'query': state.query,
+          'position': state.position,
+          'height': state.height,
+          'excludedLabels': state.excludedLabels,
+          'includedLabels': state.includedLabels,
+          'count': returnCount}
+
+
 def getMessages(state, **kwargs):
   '''
   Function to get the list of messages. Essentially just a small preprocessing
@@ -1734,17 +2120,45 @@ def getMessages(state, **kwargs):
     List of messages.
   '''
   returnCount = kwargs.get('returnCount', False)
-  afterAction = kwargs.get('afterAction', None)
-  data = {'action': 'GET_MESSAGES',
-          'account': state.account,
-          'query': state.query,
-          'position': state.position,
-          'height': state.height,
-          'excludedLabels': state.excludedLabels,
-          'includedLabels': state.includedLabels,
-          'count': returnCount,
-          'afterAction': afterAction}
-  return sendToServer(data, state.globalLock)
+  data = _getMessagesData(state, returnCount)
+  response = sendToServer(data, state.globalLock)
+  return response if returnCount else decodeMessages(response)
+
+
+def getPage(state):
+  '''
+  Get the list of messages and the number of messages, both requests are
+  pipelined so this costs a single round trip.
+
+  Args:
+    state: State(), the state of pmail.
+
+  Returns:
+    (List of messages, number of messages)
+  '''
+  messages = sendToServerAsync(_getMessagesData(state, False),
+                               state.globalLock)
+  numOfMessages = sendToServerAsync(_getMessagesData(state, True),
+                                    state.globalLock)
+  return decodeMessages(messages.result()), numOfMessages.result()
+
+
+def getMessageInfo(message, lock):
+  '''
+  The message list only holds the columns needed to draw it, get the full
+  MessageInfo object for a message, e.g. before replying to it.
+
+  Args:
+    message: MessageSummary object.
+    lock: threading.Lock().
+
+  Returns:
+    MessageInfo object.
+  '''
+  data = {'action': 'GET_QUERY',
+          'class': MessageInfo,
+          'messageIds': [message.messageId]}
+  return sendToServer(data, lock)[0]
 
 
 def mainLoop(lock, accountSwitcher, eventQue):
@@ -1758,8 +2172,10 @@ def mainLoop(lock, accountSwitcher, eventQue):
   # Initialise the state.
   state = State(account=account,
                 lock=lock)
+  downloads.onEvent = eventQue.put
   try:
     labelMap = sendToServer({'action': 'GET_LABEL_MAP'}, lock)
+    subscribe(lock, eventQue)
   except ConnectionError:
     print('Could not connect to server!\r\n')
     logger.warning('Could not connect to the server.')
@@ -1783,33 +2199,21 @@ def mainLoop(lock, accountSwitcher, eventQue):
       sys.exit()
 
 
-def checkForNewMessages(lock, eventQue):
+def subscribe(lock, eventQue):
   '''
-  Function to ask the server if new messages have arrived.
+  Ask the server to tell us when something changes, e.g. new messages
+  arrived, rather than polling for it.
 
   Args:
     lock: threading.Lock()
-    eventQue: Queue() in which to put an event if new messages did arrive.
+    eventQue: Queue() in which to put events pushed by the server.
 
   Returns:
     None
-  TODO: Make this listen to the server (implement this as a server?)
   '''
-  data = {'action': 'CHECK_FOR_NEW_MESSAGES',
-          }
-  logger.info('Asking server if anything new showed up.')
-  while 1:
-    try:
-      response = sendToServer(data, lock)
-      if response == 'newMessagesArrived':
-        logger.info('New message detected.')
-        # newMessagesArrived.clear()
-        eventQue.put({'event': 'NewMsg'})
-      sleep(10)
-    except ConnectionError:
-      print('Could not connect to server!\r\n')
-      logger.warning('Could not connect to the server.')
-      sys.exit()
+  connection.onEvent = eventQue.put
+  sendToServer({'action': 'SUBSCRIBE'}, lock)
+  logger.info('Subscribed to events from the server.')
 
 
 def checkPrograms():
@@ -1906,10 +2310,7 @@ def start():
   lock = Lock()
   eventQue = Queue()
   t1 = Thread(target=mainLoop, args=(lock, accountSwitcher, eventQue,))
-  t2 = Thread(target=checkForNewMessages, args=(lock, eventQue,),
-              daemon=True)
   t1.start()
-  t2.start()
 
   # Clean up tmp files.
   for f in os.listdir(config.tmpDir):
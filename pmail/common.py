@@ -2,30 +2,68 @@
 
 # ---> Imports
 from __future__ import print_function
-from itertools import chain
 import sys
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import os
 import os.path
 import re
 import pickle
 import logging
+import json
+import hashlib
+import email
+import email.policy
+import html
+import shlex
+from time import time
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Event, Lock, local
 import yaml
 from yaml import Loader
 from sqlalchemy import create_engine  # desc, UniqueConstraint
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index
+from sqlalchemy import MetaData, inspect, event, text, bindparam
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import sessionmaker, relationship, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
-from googleapiclient.discovery import build
 from googleapiclient.discovery_cache.base import Cache
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from googleapiclient.version import __version__ as apiClientVersion
+from pmail import quota
+from pmail.quota import execute, executeBatch
+# The google api client, its http stack and the oauth flow take a good part
+# of a second to import. They are imported where they are used instead, so
+# that e.g. pmail -n, which only reads the db, starts quickly.
 # <---
 
 # ---> Initial definitions
 
 WORKING_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Upper bound on sync_fetchers. Every batch is 100 messages.get calls, so
+# more concurrent batches than this just runs into gmail's per user quota.
+MAX_SYNC_FETCHERS = 8
+
+# Pragmas set on every connection to the db, see setPragmas.
+# 'fast': WAL journal, so readers (e.g. pmail -n) don't wait for the syncer,
+# and only fsync at checkpoints rather than on every commit.
+# 'durable': sqlite's own defaults, a rollback journal and a full fsync on
+# every commit.
+STORAGE_PROFILES = {
+    'fast': {'journal_mode': 'WAL',
+             'synchronous': 'NORMAL',
+             'mmap_size': 256 * 1024 * 1024,
+             'cache_size': -64 * 1024,
+             'temp_store': 'MEMORY'},
+    'durable': {'journal_mode': 'DELETE',
+                'synchronous': 'FULL',
+                'mmap_size': 0,
+                'cache_size': -2000,
+                'temp_store': 'DEFAULT'}
+}
+
 
 class Config():
   def __init__(self, **kwargs):
@@ -91,6 +129,42 @@ class Config():
       sys.exit()
     self.updateFreq = b['update_frequency']
     self.port = b['port_number']
+    self.transport = b.get('transport', 'tcp')
+    if self.transport not in ['tcp', 'unix']:
+      print("WARNING: transport incorrectly configured, " +
+            "transport must be one of 'tcp' or 'unix'\r\n")
+      sys.exit()
+    self.socketPath = b.get('socket_path',
+                            os.path.join(home, pmailDir, 'pmail.sock'))
+    self.serverWorkers = b.get('server_workers', 4)
+    self.viewCacheEntries = b.get('view_cache_entries', 8)
+    self.viewCacheMemory = b.get('view_cache_memory', 16) * 1024 * 1024
+    self.bodyCacheDir = b.get('body_cache_directory',
+                              os.path.join(home, pmailDir, 'bodies'))
+    self.bodyCacheSize = b.get('body_cache_size', 200) * 1024 * 1024
+    self.bodyPrefetch = b.get('body_prefetch', 5)
+    self.searchGmail = b.get('search_gmail', False)
+    self.syncFetchers = b.get('sync_fetchers', 4)
+    if self.syncFetchers > MAX_SYNC_FETCHERS:
+      print("WARNING: sync_fetchers is capped at {}\r\n"
+            .format(MAX_SYNC_FETCHERS))
+      self.syncFetchers = MAX_SYNC_FETCHERS
+    self.apiQuota = b.get('api_quota', 250)
+    quota.limiter.setRate(self.apiQuota)
+    self.storageProfile = b.get('storage_profile', 'fast')
+    if self.storageProfile not in STORAGE_PROFILES:
+      print("WARNING: storage_profile incorrectly configured, " +
+            "storage_profile must be one of {}\r\n"
+            .format(', '.join(STORAGE_PROFILES)))
+      sys.exit()
+    self.sqlitePragmas = dict(STORAGE_PROFILES[self.storageProfile])
+    pragmas = b.get('sqlite_pragmas') or {}
+    if not set(pragmas) <= set(self.sqlitePragmas):
+      print("WARNING: sqlite_pragmas incorrectly configured, " +
+            "the pragmas which can be set are {}\r\n"
+            .format(', '.join(self.sqlitePragmas)))
+      sys.exit()
+    self.sqlitePragmas.update(pragmas)
 
     am = y['appearance']['markers']
     ac = y['appearance']['colors']
@@ -175,7 +249,27 @@ DB_PATH = 'sqlite:///' + os.path.join(WORKING_DIR, config.dbPath)
 HEADERS = ['From', 'Subject', 'To', 'Reply-To', 'In-Reply-To',
            'References', 'Message-ID', 'Content-Type']
 
+
+def setPragmas(engine, pragmas):
+  '''
+  Set pragmas on every connection the engine opens.
+
+  Args:
+    engine: An sqlite engine.
+    pragmas: A dict mapping pragma names to values, e.g. config.sqlitePragmas.
+
+  Returns: None.
+  '''
+  @event.listens_for(engine, 'connect')
+  def _setPragmas(dbapiConnection, connectionRecord):
+    cursor = dbapiConnection.cursor()
+    for name, value in pragmas.items():
+      cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
 engine = create_engine(DB_PATH)
+setPragmas(engine, config.sqlitePragmas)
 Base = declarative_base(bind=engine)
 
 session_factory = sessionmaker(bind=engine,
@@ -187,32 +281,71 @@ Session = scoped_session(session_factory)
 # ---> mkService
 
 
+# Seconds for which a cached discovery document is used, see DiscoveryCache.
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+
+# Refresh access tokens this long before they expire, so that a sync never
+# starts with a token which runs out half way through.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+_credentials = {}
+_credentialsLock = Lock()
+# Service objects of the current thread, the API client is not thread safe.
+_threadServices = local()
+
+
+def getCredentials(account):
+  '''
+  Get the credentials of an account. They are read from disk once, and
+  refreshed when they are about to expire.
+
+  Args:
+    account: The account.
+
+  Returns:
+    google.oauth2.credentials.Credentials, shared by every thread.
+  '''
+  with _credentialsLock:
+    creds = _credentials.get(account)
+    tokenPath = os.path.join(config.pickleDir,
+                             account.split('@')[0] + '.pickle')
+    # The file *.pickle stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the
+    # first time.
+    if creds is None and os.path.exists(tokenPath):
+      with open(tokenPath, 'rb') as token:
+        creds = pickle.load(token)
+    expiring = creds is not None and creds.expiry is not None and \
+        creds.expiry - datetime.utcnow() < REFRESH_MARGIN
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds or not creds.valid or expiring:
+      if creds and creds.refresh_token:
+        from google.auth.transport.requests import Request
+        creds.refresh(Request())
+      else:
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file(
+            config.accounts[account]['credentials'], SCOPES)
+        creds = flow.run_local_server(port=8686)
+      # Save the credentials for the next run
+      with open(tokenPath, 'wb') as token:
+        pickle.dump(creds, token)
+    _credentials[account] = creds
+    return creds
+
+
 def mkService(account):
   '''
-  Make a service object for use with the API.
-  '''
-  credentialsPath = config.accounts[account]['credentials']
-  tokenPath = os.path.join(config.pickleDir, account.split('@')[0] + '.pickle')
-  creds = None
-  # The file *.pickle stores the user's access and refresh tokens, and is
-  # created automatically when the authorization flow completes for the first
-  # time.
-  if os.path.exists(tokenPath):
-    with open(tokenPath, 'rb') as token:
-      creds = pickle.load(token)
-  # If there are no (valid) credentials available, let the user log in.
-  if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-      creds.refresh(Request())
-    else:
-      flow = InstalledAppFlow.from_client_secrets_file(
-          credentialsPath, SCOPES)
-      creds = flow.run_local_server(port=8686)
-    # Save the credentials for the next run
-    with open(tokenPath, 'wb') as token:
-      pickle.dump(creds, token)
-
-  service = build('gmail', 'v1', credentials=creds, cache=MemoryCache())
+  Get a service object for use with the API. Each thread builds one per
+  account and then keeps it.
+  '''
+  services = _threadServices.__dict__.setdefault('services', {})
+  creds = getCredentials(account)
+  service = services.get(account)
+  if service is None or service._http.credentials is not creds:
+    from googleapiclient.discovery import build
+    service = build('gmail', 'v1', credentials=creds, cache=DiscoveryCache())
+    services[account] = service
   return service
 
 # <---
@@ -264,27 +397,140 @@ def unix2localTime2(unix_timestamp):
 # ---> Class defintions
 
 
-class MemoryCache(Cache):
+class DiscoveryCache(Cache):
   '''
-  This is needed so that the cache is working inside Thread
-  objects.
+  Cache for the discovery documents which build fetches. Documents are
+  kept in memory, so that it works across threads, and in files in the
+  pickle directory, so that they survive restarts. Files older than
+  DISCOVERY_TTL, or written by a different version of the api client, are
+  ignored.
   '''
   _CACHE = {}
+  directory = os.path.join(config.pickleDir, 'discovery')
+
+  def _path(self, url):
+    key = '{} {}'.format(apiClientVersion, url).encode('utf-8')
+    return os.path.join(self.directory,
+                        hashlib.sha1(key).hexdigest() + '.json')
 
   def get(self, url):
-    return MemoryCache._CACHE.get(url)
+    content = DiscoveryCache._CACHE.get(url)
+    if content is not None:
+      return content
+    try:
+      with open(self._path(url), 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if entry.get('version') != apiClientVersion or \
+       time() - entry.get('time', 0) > DISCOVERY_TTL:
+      return None
+    DiscoveryCache._CACHE[url] = entry['content']
+    return entry['content']
 
   def set(self, url, content):
-    MemoryCache._CACHE[url] = content
+    DiscoveryCache._CACHE[url] = content
+    entry = {'version': apiClientVersion, 'time': time(), 'content': content}
+    path = self._path(url)
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      # Write to a temporary file first, so that another process never reads
+      # half a document.
+      tmpPath = '{}.{}'.format(path, os.getpid())
+      with open(tmpPath, 'w', encoding='utf-8') as f:
+        json.dump(entry, f)
+      os.replace(tmpPath, path)
+    except OSError:
+      logger.exception('Could not write the discovery cache.')
+
+
+# ---> Change listeners
+
+_changeListeners = []
+
+
+def addChangeListener(listener):
+  '''
+  Register a function to be told about changes to the messages and labels
+  stored in the db, e.g. so that caches can be patched rather than rebuilt.
+
+  Args:
+    listener: Called as listener(session, change, data) where change is one
+    of:
+      'LABELS_ADDED', 'LABELS_REMOVED': data is a list of pairs (m,ls) where
+      m is a message id and ls is a list of labels.
+      'MESSAGES_ADDED', 'MESSAGES_REMOVED': data is a list of message ids.
+      'HISTORY_SYNCED': a batch of history was applied, data is a dict with
+      the account, the historyId, and whether any messages were added or
+      deleted ('messages') and whether any labels changed ('labels').
+  '''
+  _changeListeners.append(listener)
+
+
+def notifyChange(session, change, data):
+  '''
+  Record a change made in session. The change listeners are told about it
+  by commitChanges, once it has been committed. If the session is rolled back
+  instead the change is forgotten.
+  '''
+  if len(data) == 0:
+    return
+  session.info.setdefault('changes', []).append((change, data))
+
+
+@event.listens_for(session_factory, 'after_commit')
+def _changesCommitted(session):
+  session.info.setdefault('committed', [])\
+      .extend(session.info.pop('changes', []))
+
+
+@event.listens_for(session_factory, 'after_rollback')
+def _changesRolledBack(session):
+  session.info.pop('changes', None)
+
+
+def commitChanges(session):
+  '''
+  Commit session, then tell the change listeners about everything which has
+  been committed since they were last called.
+
+  Args:
+    session: A DB session.
+
+  Returns: None.
+  '''
+  session.commit()
+  for (change, data) in session.info.pop('committed', []):
+    for listener in _changeListeners:
+      try:
+        listener(session, change, data)
+      except Exception:
+        logger.exception('A change listener failed on {}.'.format(change))
+
+# <---
+
+
+def _partFields(depth):
+  fields = 'partId,filename,mimeType,body/size'
+  if depth > 0:
+    fields += ',parts(' + _partFields(depth - 1) + ')'
+  return fields
+
+
+# Only the structure of a message, not its content, is needed to find its
+# attachments. Parts are nested this deep at most.
+ATTACHMENT_FIELDS = 'id,payload(' + _partFields(4) + ')'
 
 
 class Attachments(Base):
   '''
-  Store Attachments.
+  Store Attachments. They are fetched during sync for messages with the
+  ATTACHMENT label, see setupAttachments, and MessageInfo.hasAttachments
+  records that a message has been looked at.
   '''
   __tablename__ = 'attachments'
   id = Column(Integer, primary_key=True)
-  messageId = Column(String, ForeignKey('header_info.messageId'))
+  messageId = Column(String, ForeignKey('header_info.messageId'), index=True)
   partId = Column(String)
   filename = Column(String)
   contentType = Column(String)
@@ -313,6 +559,104 @@ class Attachments(Base):
         self.filename)
     return display
 
+  @classmethod
+  def fromPayload(cls, messageId, payload):
+    '''
+    Find the attachments in the payload of a message, including those in
+    nested parts.
+
+    Returns:
+      A list of dicts, ready to be inserted.
+    '''
+    attachments = []
+    if payload.get('filename'):
+      attachments.append({'messageId': messageId,
+                          'partId': payload['partId'],
+                          'filename': payload['filename'],
+                          'contentType': payload['mimeType'],
+                          'size': payload.get('body', {}).get('size', 0)})
+    for part in payload.get('parts', []):
+      attachments += cls.fromPayload(messageId, part)
+    return attachments
+
+  @staticmethod
+  def pending(session, messageIds):
+    '''
+    Find the messages whose attachments have not been looked at yet.
+
+    Args:
+      session: A db session.
+      messageIds: List of message ids.
+
+    Returns:
+      A list of those message ids which are in the db and not looked at.
+    '''
+    messageIds = list(set(messageIds))
+    q = []
+    for i in range(0, len(messageIds), 500):
+      q += [messageId for (messageId,) in
+            session.query(MessageInfo.messageId)
+            .filter(MessageInfo.messageId.in_(messageIds[i:i + 500]))
+            .filter(MessageInfo.hasAttachments.is_(None))]
+    return q
+
+  @staticmethod
+  def fetch(service, messageIds):
+    '''
+    Get the part structure of messages from gmail. Does not use the db, so
+    it can be done without holding the lock, see storeParts.
+
+    Returns:
+      A list of the responses.
+    '''
+    return [response for responses in
+            fetchMessages(service, list(messageIds), format='full',
+                          fields=ATTACHMENT_FIELDS)
+            for response in responses]
+
+  @classmethod
+  def storeParts(cls, session, responses):
+    '''
+    Store the attachments found in responses from fetch. Messages which
+    have been looked at since, or are not in the db, are skipped. Does not
+    commit.
+
+    Returns: None.
+    '''
+    pending = set(cls.pending(session, [r['id'] for r in responses]))
+    rows, found = [], {True: [], False: []}
+    for response in responses:
+      if response['id'] not in pending:
+        continue
+      attachments = cls.fromPayload(response['id'], response['payload'])
+      rows += attachments
+      found[len(attachments) > 0].append(response['id'])
+    if rows:
+      session.execute(cls.__table__.insert(), rows)
+    for hasAttachments, ids in found.items():
+      for i in range(0, len(ids), 500):
+        session.query(MessageInfo)\
+            .filter(MessageInfo.messageId.in_(ids[i:i + 500]))\
+            .update({MessageInfo.hasAttachments: hasAttachments},
+                    synchronize_session=False)
+
+  @classmethod
+  def addAttachments(cls, session, service, messageIds):
+    '''
+    Fetch and store the attachments of messages which have not been looked
+    at yet. Messages which are not in the db are skipped. Does not commit.
+
+    Args:
+      session: A db session.
+      service: An API service.
+      messageIds: List of message ids.
+
+    Returns: None.
+    '''
+    for responses in fetchMessages(service, cls.pending(session, messageIds),
+                                   format='full', fields=ATTACHMENT_FIELDS):
+      cls.storeParts(session, responses)
+
 
 class AddressBook(Base):
   '''
@@ -325,19 +669,41 @@ class AddressBook(Base):
                    primary_key=True)
   address = Column(String, primary_key=True)
 
+  # The addresses of each account, so that finding new addresses does not
+  # mean reading the whole table. Cleared on rollback, see _forgetAddresses.
+  cache = {}
+
   def __init__(self, account, address):
     self.account = account
     self.address = address
 
   @classmethod
-  def mk(cls, account, session, message):
+  def addresses(cls, session, account):
     '''
-    Method to scour for email address in the MessageInfo table
-    and sort them into uniques and add to the AddressBook table
+    The set of addresses in the address book of account.
     '''
-    q = session.query(cls).filter(cls.account == account)
+    if account not in cls.cache:
+      cls.cache[account] = {address for (address,) in
+                            session.query(cls.address)
+                            .filter(cls.account == account)}
+    return cls.cache[account]
 
-    addresses = [a.address for a in q]
+  @classmethod
+  def mk(cls, account, session, message):
+    '''
+    Find the addresses in a message which are not in the address book yet.
+    They are added to the cache straight away, the caller writes them to
+    the db with add, once per batch of messages.
+
+    Args:
+      account: The account which owns the message.
+      session: A db session.
+      message: A MessageInfo.
+
+    Returns:
+      A set of addresses.
+    '''
+    addresses = cls.addresses(session, account)
     newAddresses = set()
 
     sender = message.sender.lower().strip()
@@ -352,15 +718,25 @@ class AddressBook(Base):
           newAddresses.add(address)
     except Exception:
       logger.exception('Something bad happened trying to add new addresses.')
+    addresses.update(newAddresses)
+    return newAddresses
 
-    # s.query(cls).filter(cls.account == account).delete()
-    # s.commit()
-    try:
-      session.add_all([cls(account, a) for a in newAddresses])
-      session.commit()
-    except Exception:
-      logger.exception(
-          'Something bad happened trying to commit new addresses.')
+  @classmethod
+  def add(cls, session, account, addresses):
+    '''
+    Write addresses to the address book, ignoring any which are already
+    there. Does not commit.
+
+    Args:
+      session: A db session.
+      account: The account which the addresses belong to.
+      addresses: An iterable of addresses.
+
+    Returns: None.
+    '''
+    rows = [{'account': account, 'address': a} for a in addresses]
+    if rows:
+      session.execute(cls.__table__.insert().prefix_with('OR IGNORE'), rows)
 
   @classmethod
   def addressList(cls, account):
@@ -371,6 +747,12 @@ class AddressBook(Base):
       yield address.address
 
 
+@event.listens_for(session_factory, 'after_rollback')
+def _forgetAddresses(session):
+  # The cache may hold addresses which were never committed.
+  AddressBook.cache.clear()
+
+
 class UserInfo(Base):
   '''
   Store Profile information for each account.
@@ -384,6 +766,11 @@ class UserInfo(Base):
   numOfUnreadMessages = Column(Integer)
   shouldIupdate = Column(Boolean)
   watchExpirey = Column(Integer)
+  # Checkpoint of an unfinished initial sync, see pmail.server.initialSync.
+  syncHistoryId = Column(Integer)
+  syncPageToken = Column(String)
+  syncFetched = Column(Integer)
+  syncTotal = Column(Integer)
   # token = Column(String)
   messages = relationship('MessageInfo', backref='user_info',
                           cascade='all, delete, delete-orphan')
@@ -398,6 +785,10 @@ class UserInfo(Base):
     self.numOfUnreadMessages = None
     self.shouldIupdate = True
     self.watchExpirey = None
+    self.syncHistoryId = None
+    self.syncPageToken = None
+    self.syncFetched = None
+    self.syncTotal = None
 
   @staticmethod
   def _numOfUnreadMessages(session, account):
@@ -438,13 +829,14 @@ class UserInfo(Base):
     numOfUnreadMessages = self._numOfUnreadMessages(session, account)
     self.numOfUnreadMessages = numOfUnreadMessages
     if service:
-      profile = service.users().getProfile(userId='me').execute()
+      profile = execute(service.users().getProfile(userId='me'))
       messagesTotal = profile['messagesTotal']
       threadsTotal = profile['threadsTotal']
       self.totalMessages = messagesTotal
       self.totalThreads = threadsTotal
 
-    self.historyId = lastHistoryId
+    if lastHistoryId is not None:
+      self.historyId = lastHistoryId
     session.commit()
 
 
@@ -462,27 +854,25 @@ def setupAttachments(account):
   }
 
   service = mkService(account)
-  labels = service.users().labels().list(userId='me').execute()['labels']
+  labels = execute(service.users().labels().list(userId='me'))['labels']
   if 'ATTACHMENT' not in [label['name'] for label in labels]:
-    response = service.users().labels().create(
-        userId='me', body=attachmentLabel).execute()
+    response = execute(service.users().labels().create(
+        userId='me', body=attachmentLabel))
     labelId = response['id']
   else:
     labelId = [label['id'] for label in labels
                if label['name'] == 'ATTACHMENT'][0]
-  ids = listMessagesMatchingQuery(service, account, query='has:attachment')
-  # labels = [(id, 'ATTACHMENT') for id in ids]
-  # Labels.addLabels(session, labels)
-  chunkedIds = [ids[i:i + 1000]
-                for i in range(0, int(len(ids) / 1000) + 1, 1000)]
-  for chunk in chunkedIds:
-    # print(chunk)
+  # Pages hold at most 500 ids, within batchModify's limit of 1000.
+  for page in iterMessagePages(service, 'me', query='has:attachment',
+                               maxResults=500):
+    if not page.get('messages'):
+      continue
     modify = {
         "addLabelIds": [labelId],
-        "ids": [c['id'] for c in chunk]
+        "ids": [m['id'] for m in page['messages']]
     }
-    response = service.users().messages()\
-        .batchModify(userId='me', body=modify).execute()
+    response = execute(service.users().messages()
+                       .batchModify(userId='me', body=modify))
 
   attachmentFilter = {
       "action": {
@@ -493,8 +883,8 @@ def setupAttachments(account):
       }
   }
 
-  currentFilters = service.users().settings().filters()\
-      .list(userId='me').execute()
+  currentFilters = execute(service.users().settings().filters()
+                           .list(userId='me'))
 
   for f in currentFilters['filter']:
     if 'addLabelIds' in f['action'].keys()\
@@ -504,9 +894,9 @@ def setupAttachments(account):
       # print('filter exists')
       break
   else:
-    service.users().settings().filters().create(
+    execute(service.users().settings().filters().create(
         userId='me', body=attachmentFilter
-    ).execute()
+    ))
 
 
 class LabelInfo(Base):
@@ -524,20 +914,33 @@ class LabelInfo(Base):
     self.labelAccount = account
     self.labelName = labelName
 
+  @staticmethod
+  def fetch(account):
+    '''
+    Get the labels of an account from google.
+
+    Returns:
+      A list of labels, see addLabels.
+    '''
+    service = mkService(account)
+    return execute(service.users().labels().list(userId='me'))['labels']
+
   @classmethod
-  def addLabels(cls, session, account):
+  def addLabels(cls, session, account, labels=None):
     '''
     Gets labelInfo from google and stores it.
 
     Args:
       session: A DB session.
       account: Account for which info to get.
+      labels: The labels, as returned by fetch. Fetched if None, pass them
+      in to avoid calling google while holding the lock.
 
     Returns: None.
     '''
-    service = mkService(account)
-    response = service.users().labels().list(userId='me').execute()['labels']
-    for label in response:
+    if labels is None:
+      labels = cls.fetch(account)
+    for label in labels:
       q = session.query(cls)\
           .filter(cls.labelId == label['id'])\
           .filter(cls.labelAccount == account)\
@@ -551,6 +954,18 @@ class LabelInfo(Base):
     #     .delete(synchronize_session=False)
     session.commit()
 
+  @classmethod
+  def attachmentLabel(cls, session, account):
+    '''
+    Returns:
+      The id of the ATTACHMENT label of an account, or None.
+    '''
+    q = session.query(cls.labelId)\
+        .filter(cls.labelAccount == account)\
+        .filter(cls.labelName == 'ATTACHMENT')\
+        .first()
+    return q[0] if q else None
+
   @classmethod
   def getName(cls, session):
     labelMap = {}
@@ -565,6 +980,8 @@ class Labels(Base):
   Store Labels attached to messages.
   '''
   __tablename__ = 'labels'
+  __table_args__ = (Index('ix_labels_label_message', 'labelId', 'messageId'),
+                    Index('ix_labels_message_label', 'messageId', 'labelId'))
   id = Column(Integer, primary_key=True)
   messageId = Column(String, ForeignKey('header_info.messageId'))
   labelId = Column(String, ForeignKey('label_info.labelId'))
@@ -578,100 +995,104 @@ class Labels(Base):
     # self.labelName = labelName
 
   @classmethod
-  def addLabels(cls, session, labels):
+  def existing(cls, session, messageIds):
     '''
-    Add labels to messages.
+    Look up the labels currently attached to some messages.
+
+    Args:
+      session: A DB session.
+      messageIds: An iterable of message ids.
+
+    Returns:
+      A dict mapping each message id which has labels to a set of label ids.
+    '''
+    messageIds = list(set(messageIds))
+    labels = {}
+    for i in range(0, len(messageIds), 500):
+      for (messageId, labelId) in session.query(cls.messageId, cls.labelId)\
+              .filter(cls.messageId.in_(messageIds[i:i + 500])):
+        labels.setdefault(messageId, set()).add(labelId)
+    return labels
+
+  @classmethod
+  def addLabels(cls, session, labels, commit=True):
+    '''
+    Add labels to messages. Labels which are already there are skipped, the
+    rest are written with a single executemany.
 
     Args:
       session: A DB session.
       labels: A list of pairs (m,ls) where m is a message
       id and ls is a list of labels to add to the message.
+      commit: Whether to commit, pass False to make this part of a larger
+      transaction which the caller commits with commitChanges.
 
     Returns: None.
     '''
+    existing = cls.existing(session, [m for (m, _) in labels])
+    added, rows = [], []
     for (messageId, ls) in labels:
-      for label in ls:
-        session.add(cls(messageId, label))
-        session.commit()
+      new = [l for l in dict.fromkeys(ls)
+             if l not in existing.get(messageId, ())]
+      existing.setdefault(messageId, set()).update(new)
+      if new:
+        added.append((messageId, new))
+        rows += [{'messageId': messageId, 'labelId': l} for l in new]
+    if rows:
+      session.execute(cls.__table__.insert(), rows)
+    notifyChange(session, 'LABELS_ADDED', added)
+    if commit:
+      commitChanges(session)
 
   @classmethod
-  def removeLabels(cls, session, labels):
+  def removeLabels(cls, session, labels, commit=True):
     '''
-    Remove labels from messages.
+    Remove labels from messages. The deletes are grouped by label, so this
+    is one statement per label (per 500 messages) rather than one per
+    message.
 
     Args:
       session: A DB session.
       labels: A list of pairs (m,ls) where m is a message
       id and ls is a list of labels to add to the message.
+      commit: Whether to commit, pass False to make this part of a larger
+      transaction which the caller commits with commitChanges.
 
     Returns: None.
     '''
+    existing = cls.existing(session, [m for (m, _) in labels])
+    removed, byLabel = [], {}
     for (messageId, ls) in labels:
-      session.query(cls)\
-          .filter(cls.messageId == messageId, cls.labelId.in_(ls))\
-          .delete(synchronize_session=False)
-      # logger.info('About to commit, after removing labels.')
-    session.commit()
-    logger.info('Committed, after removing labels.')
-    if 'UNREAD' in chain(*[ls for (messageId, ls) in labels]) and\
-            config.afterUnreadChange:
-      os.system(config.afterUnreadChange)
-
-# ---> MessageInfo class
-
-
-class MessageInfo(Base):
+      old = [l for l in dict.fromkeys(ls)
+             if l in existing.get(messageId, ())]
+      existing.get(messageId, set()).difference_update(old)
+      if old:
+        removed.append((messageId, old))
+      for label in old:
+        byLabel.setdefault(label, []).append(messageId)
+    for label, messageIds in byLabel.items():
+      for i in range(0, len(messageIds), 500):
+        session.query(cls)\
+            .filter(cls.labelId == label,
+                    cls.messageId.in_(messageIds[i:i + 500]))\
+            .delete(synchronize_session=False)
+    notifyChange(session, 'LABELS_REMOVED', removed)
+    if commit:
+      commitChanges(session)
+      logger.info('Committed, after removing labels.')
+      if 'UNREAD' in byLabel and config.afterUnreadChange:
+        os.system(config.afterUnreadChange)
+
+# ---> Displaying messages
+
+
+class MessageDisplay():
   '''
-  Big class for storing information about an email
+  Methods for displaying a message, shared by MessageInfo and the
+  MessageSummary objects which the client gets from the server.
+  Subclasses must provide messageId, emailAddress, time, size, snippet,
+  subject, sender and labelIds.
   '''
-  __tablename__ = 'header_info'
-  messageId = Column(String, primary_key=True)
-  emailAddress = Column(String, ForeignKey('user_info.emailAddress'))
-  historyId = Column(String)
-  time = Column(String, index=True)
-  size = Column(Integer)
-  snippet = Column(String)
-  externalId = Column(String)
-  subject = Column(String)
-  sender = Column(String)
-  replyTo = Column(String)
-  inReplyTo = Column(String)
-  references = Column(String)
-  recipients = Column(String)
-  contentType = Column(String)
-  hasAttachments = Column(Boolean)
-  labels = relationship('Labels', backref='header_info',
-                        cascade="all, delete, delete-orphan",
-                        lazy='subquery')
-  attachments = relationship('Attachments', backref='header_info',
-                             cascade="all, delete, delete-orphan")
-
-  def __init__(self, messageId, emailAddress, historyId, time, size,
-               snippet, externalId, subject, sender, replyTo, inReplyTo,
-               references, recipients, contentType):
-    self.messageId = messageId
-    self.emailAddress = emailAddress
-    self.historyId = historyId
-    self.time = time
-    self.size = size
-    self.snippet = snippet
-    self.externalId = externalId
-    self.subject = subject
-    self.sender = sender
-    self.replyTo = replyTo
-    self.inReplyTo = inReplyTo
-    self.references = references
-    self.recipients = recipients
-    self.contentType = contentType
-
-  def __eq__(self, other):
-    if isinstance(other, self.__class__):
-      return self.messageId == other.messageId
-    else:
-      return False
-
-  def __ne__(self, other):
-    return not self.__eq__(other)
 
   def display(self, senderWidth, scrWidth, labelMap):
     '''
@@ -684,7 +1105,7 @@ class MessageInfo(Base):
     Reurns:
       A formatted string.
     '''
-    if 'UNREAD' in [label.labelId for label in self.labels]:
+    if 'UNREAD' in self.labelIds:
       marker = chr(config.unread) + ' '
     else:
       marker = '  '
@@ -704,8 +1125,8 @@ class MessageInfo(Base):
     return str
 
   def showLabels(self, labelMap):
-    return [labelMap[self.emailAddress][label.labelId] 
-            for label in self.labels]
+    return [labelMap[self.emailAddress][labelId]
+            for labelId in self.labelIds]
 
   def timeForReply(self):
     '''
@@ -757,10 +1178,209 @@ class MessageInfo(Base):
       else:
         return True
     '''
-    labelIds = [label.labelId for label in self.labels]
-    labelNames = [labelMap[self.emailAddress][label] for label in labelIds]
+    labelNames = [labelMap[self.emailAddress][label]
+                  for label in self.labelIds]
     return 'ATTACHMENT' in labelNames
 
+
+class MessageSummary(MessageDisplay):
+  '''
+  The columns of a message needed to draw the message list.
+  '''
+
+  def __init__(self, messageId, emailAddress, time, size, sender, subject,
+               snippet, labelIds):
+    self.messageId = messageId
+    self.emailAddress = emailAddress
+    self.time = time
+    self.size = size
+    self.sender = sender
+    self.subject = subject
+    self.snippet = snippet
+    self.labelIds = labelIds
+
+  def __eq__(self, other):
+    if isinstance(other, MessageDisplay):
+      return self.messageId == other.messageId
+    else:
+      return False
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __hash__(self):
+    return hash(self.messageId)
+
+  def approxSize(self):
+    '''
+    Rough number of bytes used by the object.
+    '''
+    return sys.getsizeof(self) + sys.getsizeof(self.__dict__) + \
+        sum(sys.getsizeof(v) for v in (self.messageId, self.sender,
+                                        self.subject, self.snippet)) + \
+        sys.getsizeof(self.labelIds)
+
+  @staticmethod
+  def columns():
+    '''
+    The MessageInfo columns needed to make a MessageSummary, pass these to
+    session.query and hand the rows to fromRows.
+    '''
+    return (MessageInfo.messageId, MessageInfo.emailAddress, MessageInfo.time,
+            MessageInfo.size, MessageInfo.sender, MessageInfo.subject,
+            MessageInfo.snippet)
+
+  @classmethod
+  def fromRows(cls, session, rows):
+    '''
+    Make MessageSummary objects from rows of a query over columns(). The
+    labels are read from the labels table with one more query, rather than
+    through the MessageInfo.labels relationship, so they are never stale.
+
+    Args:
+      session: A DB session.
+      rows: Rows of a query over MessageSummary.columns().
+
+    Returns:
+      List of MessageSummary objects in the same order as rows.
+    '''
+    labels = {row.messageId: [] for row in rows}
+    ids = list(labels)
+    for i in range(0, len(ids), 500):
+      q = session.query(Labels.messageId, Labels.labelId)\
+          .filter(Labels.messageId.in_(ids[i:i + 500]))
+      for messageId, labelId in q:
+        labels[messageId].append(labelId)
+    return [cls(row.messageId, row.emailAddress, int(row.time), row.size,
+                row.sender, row.subject, row.snippet, labels[row.messageId])
+            for row in rows]
+
+  @classmethod
+  def load(cls, session, messageIds):
+    '''
+    Load the messages with the given ids.
+
+    Returns:
+      Dictionary messageId -> MessageSummary, messages which are not in the
+      db are left out.
+    '''
+    messageIds = list(messageIds)
+    rows = []
+    for i in range(0, len(messageIds), 500):
+      rows += session.query(*cls.columns())\
+          .filter(MessageInfo.messageId.in_(messageIds[i:i + 500])).all()
+    return {m.messageId: m for m in cls.fromRows(session, rows)}
+
+
+# Bump this whenever the layout of a row in encodeMessages changes.
+WIRE_VERSION = 1
+
+
+def encodeMessages(messages):
+  '''
+  Encode messages for sending to the client. Rather than pickling whole
+  MessageInfo objects (along with their labels and sqlalchemy state) each
+  message becomes a tuple holding only what the message list needs. Accounts
+  and label ids are sent once in a table and rows refer to them by index.
+
+  Args:
+    messages: List of MessageInfo or MessageSummary objects.
+
+  Returns:
+    (WIRE_VERSION, accounts, labelIds, rows)
+  '''
+  accounts, labelIds = {}, {}
+  rows = []
+  for m in messages:
+    account = accounts.setdefault(m.emailAddress, len(accounts))
+    labels = tuple(labelIds.setdefault(labelId, len(labelIds))
+                   for labelId in m.labelIds)
+    rows.append((m.messageId, account, int(m.time), m.size, m.sender,
+                 m.subject, m.snippet, labels))
+  return (WIRE_VERSION, tuple(accounts), tuple(labelIds), rows)
+
+
+def decodeMessages(payload):
+  '''
+  Decode the output of encodeMessages.
+
+  Returns:
+    List of MessageSummary objects.
+  '''
+  version, accounts, labelIds, rows = payload
+  if version != WIRE_VERSION:
+    raise ValueError('Unsupported wire version {}, expected {}. '
+                     .format(version, WIRE_VERSION) +
+                     'Are the client and server the same version?')
+  return [MessageSummary(messageId, accounts[account], time, size, sender,
+                         subject, snippet, [labelIds[i] for i in labels])
+          for (messageId, account, time, size, sender, subject, snippet,
+               labels) in rows]
+
+# <---
+
+# ---> MessageInfo class
+
+
+class MessageInfo(MessageDisplay, Base):
+  '''
+  Big class for storing information about an email
+  '''
+  __tablename__ = 'header_info'
+  __table_args__ = (Index('ix_header_info_account_time',
+                          'emailAddress', 'time'),)
+  messageId = Column(String, primary_key=True)
+  emailAddress = Column(String, ForeignKey('user_info.emailAddress'))
+  historyId = Column(String)
+  time = Column(Integer, index=True)
+  size = Column(Integer)
+  snippet = Column(String)
+  externalId = Column(String)
+  subject = Column(String)
+  sender = Column(String)
+  replyTo = Column(String)
+  inReplyTo = Column(String)
+  references = Column(String)
+  recipients = Column(String)
+  contentType = Column(String)
+  hasAttachments = Column(Boolean)
+  labels = relationship('Labels', backref='header_info',
+                        cascade="all, delete, delete-orphan",
+                        lazy='subquery')
+  attachments = relationship('Attachments', backref='header_info',
+                             cascade="all, delete, delete-orphan")
+
+  def __init__(self, messageId, emailAddress, historyId, time, size,
+               snippet, externalId, subject, sender, replyTo, inReplyTo,
+               references, recipients, contentType):
+    self.messageId = messageId
+    self.emailAddress = emailAddress
+    self.historyId = historyId
+    self.time = time
+    self.size = size
+    self.snippet = snippet
+    self.externalId = externalId
+    self.subject = subject
+    self.sender = sender
+    self.replyTo = replyTo
+    self.inReplyTo = inReplyTo
+    self.references = references
+    self.recipients = recipients
+    self.contentType = contentType
+
+  def __eq__(self, other):
+    if isinstance(other, self.__class__):
+      return self.messageId == other.messageId
+    else:
+      return False
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  @property
+  def labelIds(self):
+    return [label.labelId for label in self.labels]
+
   @classmethod
   def addMessage(cls, account, session, msg):
     '''
@@ -791,7 +1411,7 @@ class MessageInfo(Base):
           msg['id'],
           account,
           msg['historyId'],
-          msg['internalDate'],
+          int(msg['internalDate']),
           msg['sizeEstimate'],
           msg['snippet'],
           headers['Message-ID'],
@@ -811,7 +1431,27 @@ class MessageInfo(Base):
       return None
 
   @classmethod
-  def addMessages(cls, session, account, service, messageIds):
+  def existing(cls, session, messageIds):
+    '''
+    Find which messages are already in the db.
+
+    Args:
+      session: A db session.
+      messageIds: An iterable of message ids.
+
+    Returns:
+      The set of those message ids which are in the db.
+    '''
+    messageIds = list(set(messageIds))
+    existing = set()
+    for i in range(0, len(messageIds), 500):
+      existing.update(messageId for (messageId,) in
+                      session.query(cls.messageId)
+                      .filter(cls.messageId.in_(messageIds[i:i + 500])))
+    return existing
+
+  @classmethod
+  def addMessages(cls, session, account, service, messageIds, commit=True):
     '''
     Add many messages to the db.
 
@@ -820,60 +1460,102 @@ class MessageInfo(Base):
       account: The accoun which owns the messages
       service: An API service.
       messageIds: List of message ids which we are going to add.
+      commit: Whether to commit, see Labels.addLabels. When True the
+      messages are committed every SYNC_COMMIT_BATCHES batches.
     '''
-    def doesMessageAlreadyExist(messageId):
-      q = session.query(cls).filter(cls.messageId == messageId)
-      if q.first():
-        return False
-      else:
-        return True
+    withAttachments = []
+    # The batches are fetched concurrently, this thread is the only one
+    # which writes to the db.
+    for (i, responses) in enumerate(fetchMessages(
+            service, cls.missing(session, messageIds),
+            format='metadata', metadataHeaders=HEADERS)):
+      withAttachments += cls.storeMessages(session, account, responses)
+      if commit and (i + 1) % SYNC_COMMIT_BATCHES == 0:
+        commitChanges(session)
+    Attachments.addAttachments(session, service, withAttachments)
+    if commit:
+      commitChanges(session)
 
-    def _updateDb(session, account, requestId, response, exception):
-      '''
-      Helper function for batch requests.
-
-      Args:
-        session: A DB session.
-        account: The account which the messages belong to.
-        requestId: Id of the request.
-        response: Response of the request (If succesful, this is the message)
-        exception: An exception if something went wrong.
-      '''
-      if exception is not None:
-        logger.exception('There was an Error while trying to update db.')
-        # Do something with the exception
-        # See BatchHttpRequest docs
-      else:
-        # Parse headers.
-        message = cls.addMessage(account, session, response)
-        if message:
-          AddressBook.mk(account, session, message)
-
-    q = list(filter(doesMessageAlreadyExist, messageIds))
-    i, l, batch = 0, len(q), service.new_batch_http_request()
-    # logger.debug('Making batch request..')
-
-    while i < l:
-      for messageId in q[i:i + 100]:
-        batch.add(service.users().messages().get(
-            userId='me',
-            id=messageId,
-            format='metadata',
-            metadataHeaders=HEADERS
-        ), callback=(lambda x, y, z: _updateDb(session, account, x, y, z)))
-      batch.execute()
-      batch = service.new_batch_http_request()
-      i += 100
-    session.commit()
+  @classmethod
+  def missing(cls, session, messageIds):
+    '''
+    Returns:
+      The message ids which are not in the db yet, in order and without
+      duplicates.
+    '''
+    existing = cls.existing(session, messageIds)
+    return [m for m in dict.fromkeys(messageIds) if m not in existing]
+
+  @staticmethod
+  def fetch(service, messageIds):
+    '''
+    Get the headers of messages from gmail. Does not use the db, so it can
+    be done without holding the lock, see storeMessages.
+
+    Returns:
+      A list of the responses.
+    '''
+    return [response for responses in
+            fetchMessages(service, list(messageIds), format='metadata',
+                          metadataHeaders=HEADERS)
+            for response in responses]
 
   @classmethod
-  def removeMessages(cls, session, messageIds):
+  def storeMessages(cls, session, account, responses):
     '''
-    Delete messages (Not in use currently and
-    might need extra scopes to work.)
+    Add messages fetched by fetch to the db, along with their addresses and
+    their entries in the search index. Messages which are already in the db
+    are skipped. Does not commit.
+
+    Args:
+      session: A db session.
+      account: The account which owns the messages.
+      responses: List of messages from gmail.
+
+    Returns:
+      The ids of the messages added which have the ATTACHMENT label.
     '''
-    session.query(cls).filter(cls.messageId in
-                              messageIds).delete(synchronize_session=False)
+    attachmentLabel = LabelInfo.attachmentLabel(session, account)
+    existing = cls.existing(session, [r['id'] for r in responses])
+    added, newAddresses, withAttachments = [], set(), []
+    for response in responses:
+      if response['id'] in existing:
+        continue
+      message = cls.addMessage(account, session, response)
+      if message:
+        existing.add(message.messageId)
+        added.append(message.messageId)
+        newAddresses.update(AddressBook.mk(account, session, message))
+        if attachmentLabel in response.get('labelIds', []):
+          withAttachments.append(message.messageId)
+    AddressBook.add(session, account, newAddresses)
+    MessageSearch.index(session, added)
+    notifyChange(session, 'MESSAGES_ADDED', added)
+    return withAttachments
+
+  @classmethod
+  def removeMessages(cls, session, messageIds, commit=True):
+    '''
+    Delete messages, and their labels and attachments, from the local db. Used when messages
+    were deleted from the remote mailbox.
+
+    Args:
+      session: A db session.
+      messageIds: List of message ids to delete.
+      commit: Whether to commit, see Labels.addLabels.
+    '''
+    MessageSearch.unindex(session, messageIds)
+    for i in range(0, len(messageIds), 500):
+      chunk = messageIds[i:i + 500]
+      session.query(Labels).filter(Labels.messageId.in_(chunk))\
+          .delete(synchronize_session=False)
+      session.query(Attachments).filter(Attachments.messageId.in_(chunk))\
+          .delete(synchronize_session=False)
+      session.query(cls).filter(cls.messageId.in_(chunk))\
+          .delete(synchronize_session=False)
+    notifyChange(session, 'MESSAGES_REMOVED', messageIds)
+    if commit:
+      commitChanges(session)
 
 # <---
 
@@ -882,6 +1564,32 @@ class MessageInfo(Base):
 # ---> Getting message Id's from Google
 
 
+def iterMessagePages(service, user_id, query='', pageToken=None,
+                     maxResults=None):
+  '''
+  List the messages matching a query, a page at a time, so that each page can
+  be used as soon as it arrives.
+
+  Args:
+    service: Authorized Gmail API service instance.
+    user_id: User's email address, or 'me'.
+    query: String used to filter messages returned.
+    pageToken: Start from this page, see the nextPageToken of the pages.
+    maxResults: Maximum number of messages in each page, None for gmail's
+    default.
+
+  Returns:
+    A generator of the responses of messages.list, one per page.
+  '''
+  while 1:
+    response = execute(service.users().messages().list(
+        userId=user_id, q=query, pageToken=pageToken, maxResults=maxResults))
+    yield response
+    pageToken = response.get('nextPageToken')
+    if pageToken is None:
+      return
+
+
 def listMessagesMatchingQuery(service, user_id, query=''):
   """List all Messages of the user's mailbox matching the query.
 
@@ -898,22 +1606,342 @@ def listMessagesMatchingQuery(service, user_id, query=''):
     appropriate ID to get the details of a Message.
   """
   try:
-    response = service.users().messages().list(userId=user_id,
-                                               q=query).execute()
-    messages = []
-    if 'messages' in response:
-      messages.extend(response['messages'])
-
-    while 'nextPageToken' in response:
-      page_token = response['nextPageToken']
-      response = service.users().messages().list(userId=user_id, q=query,
-                                                 pageToken=page_token).execute()
-      messages.extend(response['messages'])
-
-    return messages
+    return [m for response in iterMessagePages(service, user_id, query)
+            for m in response.get('messages', [])]
   except Exception:
     logger.exception('Error trying to list messages mathching a query.')
 
+
+# Number of batches of messages added between commits during a sync.
+SYNC_COMMIT_BATCHES = 10
+
+
+def fetchMessages(service, messageIds, **kwargs):
+  '''
+  Get messages with batch requests of 100. Up to config.syncFetchers batches
+  are in flight at once, and at most that many finished batches are held
+  waiting for the caller, so a slow consumer holds the fetchers back.
+  Throttled messages are retried, see pmail.quota.executeBatch.
+
+  Args:
+    service: Authorized Gmail API service instance.
+    messageIds: List of message ids.
+    kwargs: Passed on to messages().get, e.g. format='metadata'.
+
+  Yields:
+    A list of the messages in each batch, in the order the batches finish.
+    Messages which could not be fetched are logged and left out.
+  '''
+  batches = [messageIds[i:i + 100] for i in range(0, len(messageIds), 100)]
+  if not batches:
+    return
+  results = Queue(maxsize=config.syncFetchers)
+  stop = Event()
+  threadState = local()
+
+  from googleapiclient.http import build_http
+  from google_auth_httplib2 import AuthorizedHttp
+
+  def mkHttp():
+    # httplib2, which the API client uses, is not thread safe.
+    threadState.http = AuthorizedHttp(service._http.credentials,
+                                      http=build_http())
+
+  def callback(responses, requestId, response, exception):
+    if exception is not None:
+      logger.error('Could not get message {}: {}'.format(requestId, exception))
+    else:
+      responses.append(response)
+
+  def fetch(batchIds):
+    responses = []
+    try:
+      if stop.is_set():
+        return
+      requests = {messageId: service.users().messages().get(
+          userId='me', id=messageId, **kwargs) for messageId in batchIds}
+      executeBatch(service, requests,
+                   lambda x, y, z: callback(responses, x, y, z),
+                   http=threadState.http)
+    except Exception:
+      logger.exception('A batch request failed.')
+    finally:
+      while not stop.is_set():
+        try:
+          results.put(responses, timeout=1)
+          break
+        except Full:
+          pass
+
+  with ThreadPoolExecutor(max_workers=config.syncFetchers,
+                          initializer=mkHttp) as pool:
+    try:
+      for batchIds in batches:
+        pool.submit(fetch, batchIds)
+      for _ in batches:
+        yield results.get()
+    finally:
+      stop.set()
+
+# <---
+
+# ---> Full text search
+'''
+Searches are answered locally with an fts5 table over the headers of the
+messages and, once they have been cached, their bodies. Each row holds the
+messageId of its message, which searches join header_info on. The rowids
+of the rows are kept in search_ids, see SearchIds, so that a message's row
+can be found without scanning the index. The implicit rowid of header_info
+is not used, since VACUUM may renumber it.
+
+The results of a search are kept in the db, see SearchResults, and clients
+refer to them by a handle.
+'''
+
+SEARCH_TABLE = '''CREATE VIRTUAL TABLE IF NOT EXISTS message_search
+USING fts5(messageId UNINDEXED, subject, sender, recipients, snippet, body,
+           tokenize='unicode61 remove_diacritics 2')'''
+SEARCH_COLUMNS = 'subject, sender, recipients, snippet'
+
+# Only the start of long bodies is indexed.
+MAX_INDEXED_BODY = 100000
+
+# Search operators which can be answered locally, and the column they
+# search.
+SEARCH_OPERATORS = {'from': 'sender', 'to': 'recipients', 'subject': 'subject'}
+# The other operators gmail understands, see
+# https://support.google.com/mail/answer/7190
+GMAIL_OPERATORS = {'cc', 'bcc', 'label', 'has', 'is', 'in', 'list',
+                   'filename', 'after', 'before', 'older', 'newer',
+                   'older_than', 'newer_than', 'deliveredto', 'category',
+                   'size', 'larger', 'smaller', 'rfc822msgid', 'around'}
+
+
+class SearchIds(Base):
+  '''
+  The rowid in message_search of each indexed message. An INTEGER PRIMARY
+  KEY is never renumbered.
+  '''
+  __tablename__ = 'search_ids'
+  id = Column(Integer, primary_key=True)
+  messageId = Column(String, unique=True)
+
+
+class MessageSearch():
+  '''
+  The full text index. Nothing here commits, the index changes in the same
+  transaction as the messages.
+  '''
+  # False if sqlite was built without fts5, searches then go to gmail.
+  available = True
+
+  @classmethod
+  def index(cls, session, messageIds):
+    '''
+    Add the headers of messages which were just added to the index.
+    '''
+    if not cls.available or not messageIds:
+      return
+    session.flush()
+    for i in range(0, len(messageIds), 500):
+      ids = {'ids': messageIds[i:i + 500]}
+      session.execute(text(
+          'INSERT OR IGNORE INTO search_ids (messageId) '
+          'SELECT messageId FROM header_info WHERE messageId IN :ids')
+          .bindparams(bindparam('ids', expanding=True)), ids)
+      session.execute(text(
+          'INSERT INTO message_search (rowid, messageId, {0}) '
+          'SELECT s.id, h.messageId, {1} FROM header_info h '
+          'JOIN search_ids s ON s.messageId = h.messageId '
+          'WHERE h.messageId IN :ids'
+          .format(SEARCH_COLUMNS, ', '.join(
+              'h.' + c for c in SEARCH_COLUMNS.split(', '))))
+          .bindparams(bindparam('ids', expanding=True)), ids)
+
+  @classmethod
+  def unindex(cls, session, messageIds):
+    '''
+    Remove messages, which are about to be deleted, from the index.
+    '''
+    if not cls.available or not messageIds:
+      return
+    for i in range(0, len(messageIds), 500):
+      ids = {'ids': messageIds[i:i + 500]}
+      session.execute(text(
+          'DELETE FROM message_search WHERE rowid IN '
+          '(SELECT id FROM search_ids WHERE messageId IN :ids)')
+          .bindparams(bindparam('ids', expanding=True)), ids)
+      session.execute(text(
+          'DELETE FROM search_ids WHERE messageId IN :ids')
+          .bindparams(bindparam('ids', expanding=True)), ids)
+
+  @classmethod
+  def setBody(cls, session, messageId, body):
+    '''
+    Add the text of the body of a message to the index.
+    '''
+    if not cls.available:
+      return
+    session.execute(text(
+        'UPDATE message_search SET body = :body WHERE rowid = '
+        '(SELECT id FROM search_ids WHERE messageId = :messageId)'),
+        {'body': body, 'messageId': messageId})
+
+  @staticmethod
+  def splitTerms(searchTerms):
+    try:
+      return shlex.split(searchTerms)
+    except ValueError:
+      return searchTerms.split()
+
+  @classmethod
+  def normalize(cls, searchTerms):
+    '''
+    The search terms with spacing, quoting and case made uniform, so that
+    searches which only differ in those can share results. OR and AND are
+    left alone since gmail only understands them in capitals.
+    '''
+    return shlex.join(word if word in ('OR', 'AND') else word.lower()
+                      for word in cls.splitTerms(searchTerms))
+
+  @classmethod
+  def matchQuery(cls, searchTerms):
+    '''
+    Turn gmail style search terms into an fts5 query. Plain words match any
+    column, from:, to: and subject: match one column, and every word matches
+    as a prefix. All words have to match.
+
+    Returns:
+      The query, or None if the terms use anything else gmail understands,
+      e.g. label: or OR, which only gmail can answer.
+    '''
+    words = cls.splitTerms(searchTerms)
+    terms = []
+    for word in words:
+      operator, _, value = word.partition(':')
+      if value and operator.lower() in SEARCH_OPERATORS:
+        column = SEARCH_OPERATORS[operator.lower()]
+      elif value and operator.lower() in GMAIL_OPERATORS or \
+          word in ('OR', 'AND') or word[:1] in ('-', '(', '{'):
+        return None
+      else:
+        column, value = None, word
+      phrase = '"{}" *'.format(value.replace('"', '""'))
+      terms.append(phrase if column is None
+                   else '{} : {}'.format(column, phrase))
+    return ' AND '.join(terms) or None
+
+  @classmethod
+  def canSearch(cls, searchTerms):
+    '''
+    Whether a search can be answered locally.
+    '''
+    return cls.available and cls.matchQuery(searchTerms) is not None
+
+  @staticmethod
+  def select(account):
+    '''
+    SQL selecting the ids of the messages which match :match, see
+    matchQuery.
+
+    Args:
+      account: Only select messages of this account (passed as :account),
+      None for all accounts.
+    '''
+    query = ('SELECT h.messageId FROM message_search '
+             'JOIN header_info h ON h.messageId = message_search.messageId '
+             'WHERE message_search MATCH :match')
+    if account:
+      query += ' AND h.emailAddress = :account'
+    return query
+
+
+class SearchResults(Base):
+  '''
+  The results of searches. Each set of results is identified by a handle,
+  which clients pass around instead of the list of message ids.
+  '''
+  __tablename__ = 'search_results'
+  handle = Column(String, primary_key=True)
+  messageId = Column(String, primary_key=True)
+
+  @classmethod
+  def create(cls, session, account, searchTerms, messageIds=()):
+    '''
+    Search the local index, if the search can be done locally, and store
+    the results together with messageIds. Does not commit.
+
+    Args:
+      session: A db session.
+      account: The account to search, None for all accounts.
+      searchTerms: What to search for.
+      messageIds: Ids of more messages to include, e.g. found by gmail.
+      Those which are not in the db are left out.
+
+    Returns:
+      The handle of the results.
+    '''
+    handle = uuid4().hex[:16]
+    if MessageSearch.canSearch(searchTerms):
+      session.execute(text(
+          'INSERT OR IGNORE INTO search_results (handle, messageId) '
+          'SELECT :handle, messageId FROM ({})'
+          .format(MessageSearch.select(account))),
+          {'handle': handle, 'account': account,
+           'match': MessageSearch.matchQuery(searchTerms)})
+    messageIds = list(set(messageIds))
+    for i in range(0, len(messageIds), 500):
+      session.execute(text(
+          'INSERT OR IGNORE INTO search_results (handle, messageId) '
+          'SELECT :handle, messageId FROM header_info WHERE messageId IN :ids')
+          .bindparams(bindparam('ids', expanding=True)),
+          {'handle': handle, 'ids': messageIds[i:i + 500]})
+    return handle
+
+  @classmethod
+  def remove(cls, session, handles):
+    '''
+    Delete sets of results. Does not commit.
+    '''
+    if handles:
+      session.query(cls).filter(cls.handle.in_(handles))\
+          .delete(synchronize_session=False)
+
+  @classmethod
+  def messageIds(cls, session, handle):
+    '''
+    Returns:
+      The set of ids of the messages in a set of results.
+    '''
+    return {messageId for (messageId,) in session.query(cls.messageId)
+            .filter(cls.handle == handle)}
+
+  @classmethod
+  def clear(cls, session):
+    '''
+    Forget all results, the handles clients had are gone with the clients.
+    '''
+    session.query(cls).delete(synchronize_session=False)
+    session.commit()
+
+
+def bodyText(raw):
+  '''
+  The text of a raw message, for the index.
+  '''
+  try:
+    msg = email.message_from_bytes(raw, policy=email.policy.default)
+    part = msg.get_body(('plain', 'html'))
+    if part is None:
+      return ''
+    content = part.get_content()
+    if part.get_content_subtype() == 'html':
+      content = html.unescape(re.sub(r'<[^>]*>', ' ', content))
+    return content[:MAX_INDEXED_BODY]
+  except Exception:
+    logger.exception('Could not get the text of a message.')
+    return ''
+
 # <---
 
 # ---> Find information
@@ -934,13 +1962,128 @@ def countAttachments(message):
 
 
 def myEmail(service):
-  return (service.users().getProfile(userId='me').execute())['emailAddress']
+  return execute(service.users().getProfile(userId='me'))['emailAddress']
 
 
 # <---
 
-# Only needed to create table structure
-Base.metadata.create_all()
+# ---> Schema migrations
+'''
+The schema version is kept in sqlite's user_version pragma. create_all only
+creates tables which don't exist yet, so anything which changes an existing
+table needs a migration here.
+'''
+
+SCHEMA_VERSION = 4
+
+
+def _rebuildMessageInfo(conn):
+  '''
+  Version 1: header_info.time used to be a string column, so rebuild the table
+  with an integer column and cast the stored values across. sqlite can't change
+  the type of a column in place.
+  '''
+  table = MessageInfo.__table__
+  metadata = MetaData()
+  # The copy needs user_info alongside it to resolve its foreign key.
+  UserInfo.__table__.tometadata(metadata)
+  new = table.tometadata(metadata, name='header_info_new')
+  conn.execute(CreateTable(new))
+  columns = ', '.join('"%s"' % c.name for c in table.columns)
+  values = ', '.join('CAST(time AS INTEGER)' if c.name == 'time'
+                     else '"%s"' % c.name for c in table.columns)
+  conn.execute('INSERT INTO header_info_new (%s) SELECT %s FROM header_info'
+               % (columns, values))
+  conn.execute('DROP TABLE header_info')
+  conn.execute('ALTER TABLE header_info_new RENAME TO header_info')
+
+
+def _addSyncColumns(conn):
+  '''
+  Version 3: user_info keeps a checkpoint of the initial sync.
+  '''
+  existing = {c['name'] for c in inspect(conn).get_columns('user_info')}
+  for column in ('syncHistoryId', 'syncPageToken', 'syncFetched',
+                 'syncTotal'):
+    if column not in existing:
+      conn.execute('ALTER TABLE user_info ADD COLUMN "%s" %s' % (
+          column, UserInfo.__table__.c[column].type.compile(conn.dialect)))
+
+
+def _rebuildSearch(conn, old):
+  '''
+  Fill message_search and search_ids from header_info.
+
+  Args:
+    conn: A connection, in a transaction.
+    old: Whether message_search_old exists, its bodies are copied across
+    and then it is dropped.
+  '''
+  conn.execute('DELETE FROM message_search')
+  conn.execute('DELETE FROM search_ids')
+  conn.execute('INSERT INTO search_ids (messageId) '
+               'SELECT messageId FROM header_info')
+  columns = ', '.join('h.' + c for c in SEARCH_COLUMNS.split(', '))
+  if old:
+    conn.execute('INSERT INTO message_search (rowid, messageId, {0}, body) '
+                 'SELECT s.id, h.messageId, {1}, o.body FROM header_info h '
+                 'JOIN search_ids s ON s.messageId = h.messageId '
+                 'LEFT JOIN message_search_old o ON o.rowid = h.rowid'
+                 .format(SEARCH_COLUMNS, columns))
+    conn.execute('DROP TABLE message_search_old')
+  else:
+    conn.execute('INSERT INTO message_search (rowid, messageId, {0}) '
+                 'SELECT s.id, h.messageId, {1} FROM header_info h '
+                 'JOIN search_ids s ON s.messageId = h.messageId'
+                 .format(SEARCH_COLUMNS, columns))
+
+
+def migrateDb():
+  '''
+  Bring an existing db up to SCHEMA_VERSION, then create any missing tables
+  and indexes.
+
+  Returns: None.
+  '''
+  with engine.begin() as conn:
+    version = conn.execute('PRAGMA user_version').scalar()
+    tables = inspect(conn).get_table_names()
+    if version < 1 and 'header_info' in tables:
+      logger.info('Migrating db to schema version 1.')
+      _rebuildMessageInfo(conn)
+    if version < 3 and 'user_info' in tables:
+      logger.info('Migrating db to schema version 3.')
+      _addSyncColumns(conn)
+    if version < 4 and 'message_search' in tables:
+      # Version 4: message_search used to be linked to header_info by
+      # rowid. The old table is kept until its bodies have been copied.
+      conn.execute('ALTER TABLE message_search RENAME TO message_search_old')
+    Base.metadata.create_all(conn)
+    try:
+      conn.execute(SEARCH_TABLE)
+    except OperationalError:
+      logger.warning('sqlite has no fts5, searches will go to gmail.')
+      MessageSearch.available = False
+    if version < 4 and 'header_info' in tables and MessageSearch.available:
+      # Version 2 added the index, version 4 relinked it.
+      logger.info('Migrating db to schema version 4.')
+      _rebuildSearch(conn, 'message_search' in tables)
+    # create_all skips indexes on tables which already exist.
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+      existing = {i['name'] for i in inspector.get_indexes(table.name)}
+      for index in table.indexes:
+        if index.name not in existing:
+          index.create(conn)
+    if version < SCHEMA_VERSION:
+      conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+      # Let the planner know about the new indexes.
+      conn.execute('ANALYZE')
+
+
+migrateDb()
+
+# <---
 
 if __name__ == '__main__':
   pass
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# ---> Imports
+import pickle
+# <---
+
+# ---> Framing
+'''
+Communication between the client and the server happens over a single long
+lived connection. Every frame is a 4 byte big-endian length followed by a
+pickle. Requests carry a 'requestId' which the server copies into the matching
+response, this means several requests can be in flight on the same connection
+at once.
+'''
+
+HEADER_SIZE = 4
+
+
+class ServerError(Exception):
+  '''
+  Raised on the client when the server failed to handle a request.
+  '''
+  pass
+
+
+def encodeFrame(obj):
+  '''
+  Pickle obj and prefix it with its length.
+
+  Args:
+    obj: Anything picklable.
+
+  Returns:
+    bytes ready to be written to a socket.
+  '''
+  payload = pickle.dumps(obj)
+  return len(payload).to_bytes(HEADER_SIZE, 'big') + payload
+
+
+def recvExactly(sock, size):
+  '''
+  Read exactly size bytes from sock.
+
+  Raises:
+    ConnectionError if the other end closed the connection.
+  '''
+  buffer = bytearray()
+  while len(buffer) < size:
+    chunk = sock.recv(size - len(buffer))
+    if not chunk:
+      raise ConnectionError('Connection closed by peer.')
+    buffer += chunk
+  return bytes(buffer)
+
+
+def recvFrame(sock):
+  '''
+  Read one frame from sock and unpickle it.
+  '''
+  size = int.from_bytes(recvExactly(sock, HEADER_SIZE), 'big')
+  return pickle.loads(recvExactly(sock, size))
+
+
+async def readFrame(reader):
+  '''
+  Read one frame from an asyncio.StreamReader and unpickle it.
+
+  Raises:
+    asyncio.IncompleteReadError if the other end closed the connection.
+  '''
+  size = int.from_bytes(await reader.readexactly(HEADER_SIZE), 'big')
+  return pickle.loads(await reader.readexactly(size))
+
+# <---
+
+"""
+vim:foldmethod=marker foldmarker=--->,<---
+"""
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+# ---> Imports
+import json
+import logging
+import random
+import socket
+from threading import Lock
+from time import sleep, monotonic
+from googleapiclient.errors import HttpError
+# <---
+
+logger = logging.getLogger(__name__)
+
+# ---> Quota
+'''
+Gmail limits each user to a number of quota units per second, and every
+method costs a different number of units, see
+https://developers.google.com/gmail/api/reference/quota
+All calls to the API should go through execute or executeBatch, which wait
+for the shared limiter and retry calls which were throttled.
+'''
+
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.watch': 100,
+    'gmail.users.stop': 50,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.messages.trash': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.drafts.create': 10,
+    'gmail.users.drafts.send': 100,
+}
+DEFAULT_UNITS = 5
+
+MAX_RETRIES = 6
+# Seconds.
+BASE_BACKOFF = 1
+MAX_BACKOFF = 64
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+# Calls which must not be repeated if gmail may already have done them, e.g.
+# a 503 or a dropped connection after a message was sent. These are only
+# retried when they were throttled, which gmail does before doing anything.
+NOT_IDEMPOTENT = {
+    'gmail.users.labels.create',
+    'gmail.users.messages.send',
+    'gmail.users.drafts.create',
+    'gmail.users.drafts.send',
+    'gmail.users.settings.filters.create',
+}
+
+
+class TokenBucket():
+  '''
+  Shared by every thread which calls the API. Callers take the units their
+  call costs, and wait if the bucket is empty. A call can cost more than
+  the bucket holds (e.g. a batch of 100 messages.get calls); the bucket then
+  goes into debt and later callers wait for it to be paid off.
+  '''
+
+  def __init__(self, rate):
+    self.rate = rate
+    self.tokens = rate
+    self.last = monotonic()
+    self.lock = Lock()
+
+  def setRate(self, rate):
+    with self.lock:
+      self.rate = rate
+      self.tokens = min(self.tokens, rate)
+
+  def acquire(self, units):
+    with self.lock:
+      now = monotonic()
+      self.tokens = min(self.rate,
+                        self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      self.tokens -= units
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+    if wait > 0:
+      sleep(wait)
+
+
+class BatchSize():
+  '''
+  The number of requests to put in a batch. Halved whenever requests in a
+  batch are throttled and grown again, a few at a time, while batches go
+  through cleanly.
+  '''
+
+  def __init__(self, maximum=100, minimum=5, step=5):
+    self.maximum = maximum
+    self.minimum = minimum
+    self.step = step
+    self.size = maximum
+    self.lock = Lock()
+
+  def throttled(self):
+    with self.lock:
+      self.size = max(self.minimum, self.size // 2)
+      logger.info('Throttled, batch size is now {}.'.format(self.size))
+
+  def succeeded(self):
+    with self.lock:
+      self.size = min(self.maximum, self.size + self.step)
+
+
+# Gmail's default quota is 250 units per user per second, see
+# config.apiQuota.
+limiter = TokenBucket(250)
+batchSize = BatchSize()
+
+
+def units(request):
+  return QUOTA_UNITS.get(getattr(request, 'methodId', None), DEFAULT_UNITS)
+
+
+def isRetryable(exception, request=None):
+  '''
+  Whether a failed call should be tried again, i.e. it was throttled or
+  the failure looks temporary. Calls in NOT_IDEMPOTENT are only retried if
+  they were throttled.
+
+  Args:
+    exception: What the call raised.
+    request: The HttpRequest which failed, None if it is not known.
+  '''
+  idempotent = getattr(request, 'methodId', None) not in NOT_IDEMPOTENT
+  if isinstance(exception, HttpError):
+    status = exception.resp.status
+    if status == 429 or (status in RETRY_STATUSES and idempotent):
+      return True
+    if status == 403:
+      try:
+        errors = json.loads(exception.content.decode('utf-8'))['error']
+        return any(e.get('reason') in RATE_LIMIT_REASONS
+                   for e in errors.get('errors', []))
+      except Exception:
+        return False
+    return False
+  return idempotent and isinstance(exception, (socket.timeout,
+                                               ConnectionError))
+
+
+def backoff(attempt):
+  '''
+  Sleep before retry number attempt (starting at 0). Exponential, with
+  jitter so that threads which were throttled together don't all retry at
+  the same moment.
+  '''
+  delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)
+  sleep(random.uniform(delay / 2, delay))
+
+
+def execute(request, **kwargs):
+  '''
+  Execute a single API request, e.g. execute(service.users().getProfile(
+  userId='me')), waiting for the limiter first and retrying it if it is
+  throttled.
+
+  Args:
+    request: A googleapiclient HttpRequest.
+    kwargs: Passed on to request.execute.
+
+  Returns:
+    The response.
+  '''
+  for attempt in range(MAX_RETRIES + 1):
+    limiter.acquire(units(request))
+    try:
+      return request.execute(**kwargs)
+    except Exception as e:
+      if attempt == MAX_RETRIES or not isRetryable(e, request):
+        raise
+      logger.warning('{} failed with {}, retrying.'
+                     .format(getattr(request, 'methodId', 'Request'), e))
+      backoff(attempt)
+
+
+def executeBatch(service, requests, callback, http=None):
+  '''
+  Execute many requests using batch requests. Requests which are throttled
+  are put back and retried in a later batch, after backing off, and the
+  batch size adapts to how often that happens.
+
+  Args:
+    service: The API service which made the requests.
+    requests: A dict mapping request ids to HttpRequests.
+    callback: Called as callback(requestId, response, exception) once for
+    every request, when it succeeded or failed for good.
+    http: The httplib2.Http to use, see pmail.common.fetchMessages.
+
+  Returns: None.
+  '''
+  pending = list(requests)
+  # Retries of each request, and the number of throttled batches in a row,
+  # which sets the backoff.
+  retries = {}
+  throttled = 0
+  while pending:
+    size = batchSize.size
+    chunk, pending = pending[:size], pending[size:]
+    retry = []
+
+    def _callback(requestId, response, exception):
+      if exception is not None and \
+         isRetryable(exception, requests[requestId]) and \
+         retries.get(requestId, 0) < MAX_RETRIES:
+        retry.append(requestId)
+      else:
+        callback(requestId, response, exception)
+
+    batch = service.new_batch_http_request()
+    for requestId in chunk:
+      batch.add(requests[requestId], callback=_callback,
+                request_id=requestId)
+    limiter.acquire(sum(units(requests[r]) for r in chunk))
+    try:
+      batch.execute(http=http)
+    except Exception as e:
+      if not isRetryable(e):
+        raise
+      retry = [r for r in chunk if retries.get(r, 0) < MAX_RETRIES and
+               isRetryable(e, requests[r])]
+      for requestId in chunk:
+        if requestId not in retry:
+          callback(requestId, None, e)
+
+    if not retry:
+      batchSize.succeeded()
+      throttled = 0
+      continue
+    batchSize.throttled()
+    for requestId in retry:
+      retries[requestId] = retries.get(requestId, 0) + 1
+    logger.info('Retrying {} throttled requests.'.format(len(retry)))
+    pending = retry + pending
+    backoff(min(throttled, MAX_RETRIES))
+    throttled += 1
+
+# <---
+
+"""
+vim:foldmethod=marker foldmarker=--->,<---
+"""
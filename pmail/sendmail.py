@@ -8,6 +8,7 @@ import os
 
 from apiclient import errors
 from pmail.common import logger, config
+from pmail.quota import execute
 from email.mime.audio import MIMEAudio
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
@@ -31,8 +32,8 @@ def sendMessage(service, userId, message):
     Sent Message.
   """
   try:
-    message = (service.users().messages().
-               send(userId=userId, body=message).execute())
+    message = execute(service.users().messages().
+                      send(userId=userId, body=message))
     # print('Message Id: %s' % message['id'])
     return message
   except errors.Error as e:
@@ -8,19 +8,29 @@ import os.path
 import os
 import sys
 import socket
+import asyncio
 # import logging
 # import argparse
 
 # from apiclient import errors
 from pmail.common import (mkService, Session, Labels, MessageInfo,
-                          listMessagesMatchingQuery, logger,
-                          UserInfo, config, setupAttachments, LabelInfo)
-from pmail.subscriber import subscribe
-# from googleapiclient.errors import HttpError
+                          iterMessagePages, logger,
+                          UserInfo, config, setupAttachments, LabelInfo,
+                          encodeMessages, MessageSummary, addChangeListener,
+                          commitChanges, Attachments, MessageSearch,
+                          bodyText, SearchResults, notifyChange)
+from sqlalchemy import func, or_, and_
+from pmail.protocol import readFrame, encodeFrame
+from pmail.quota import execute
+from pmail.bodycache import BodyCache
+from googleapiclient.errors import HttpError
 # from googleapiclient.http import BatchHttpRequest
 from threading import Thread, Lock, Event
 from time import sleep, time
 from queue import Queue, Empty
+from collections import OrderedDict
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 
 # <---
 
@@ -69,9 +79,9 @@ def getLastHistoryId(account, session):
 # ---> List changes since last update
 
 
-def ListHistory(service, user_id, start_history_id='1'):
+def iterHistoryPages(service, user_id, start_history_id='1'):
   """
-  List History of all changes to the user's mailbox.
+  List History of all changes to the user's mailbox, a page at a time.
 
  Args:
     service: Authorized Gmail API service instance.
@@ -80,23 +90,18 @@ def ListHistory(service, user_id, start_history_id='1'):
     start_history_id: Only return Histories at or after start_history_id.
 
   Returns:
-    A list of mailbox changes that occurred after the start_history_id.
+    A generator of lists of mailbox changes that occurred after the
+    start_history_id, one list per page, oldest first.
   """
-  try:
-    history = (service.users().history().list(userId=user_id,
-                                              startHistoryId=start_history_id)
-               .execute())
-    changes = history['history'] if 'history' in history else []
-    while 'nextPageToken' in history:
-      page_token = history['nextPageToken']
-      history = (service.users().history().list(userId=user_id,
-                                                startHistoryId=start_history_id,
-                                                pageToken=page_token).execute())
-      changes.extend(history['history'])
-
-    return changes
-  except Exception:
-    logger.exception('An error occured while trying to list history.')
+  pageToken = None
+  while 1:
+    history = execute(service.users().history().list(
+        userId=user_id, startHistoryId=start_history_id,
+        pageToken=pageToken))
+    yield history.get('history', [])
+    pageToken = history.get('nextPageToken')
+    if pageToken is None:
+      return
 
 # <---
 
@@ -105,34 +110,41 @@ def updateDb(account,
              session,
              service,
              newMessagesArrived,
-             lastHistoryId=None):
+             lastHistoryId,
+             lock):
   '''
-  Update the Database with messages since lastHistoryId.
+  Update the Database with the changes since lastHistoryId, see initialSync
+  for the first sync of an account. The history is applied a page at a time,
+  and UserInfo.historyId is committed with each page, so only one page is
+  held in memory and an update which is interrupted carries on from the
+  last page it applied. What a page needs from gmail is fetched without
+  holding the lock, which is only taken to apply the page.
 
   Args:
     account: The account which the messages come from.
     session: DB session.
-    service: The google API sevice object.
-    lastHistoryId: The historyId of the last update, if there was one.
+    service: Function which makes a google API service object.
+    newMessagesArrived: NotifyingEvent()
+    lastHistoryId: The historyId of the last update.
+    lock: threading.Lock()
 
   Returns:
-    historyId corresponding to this update.
-  '''
-  # 100 is maximum size of batch!
-  if lastHistoryId is None:
-    messageIds = listMessagesMatchingQuery(service(account),
-                                 'me', query='newer_than:' + config.syncFrom)
-    MessageInfo.addMessages(session, account,
-                            service(account), [m['id'] for m in messageIds])
-    lastMessageId = messageIds[0]['id']
-    LabelInfo.addLabels(session, account)
-    # logger.info('lastMessageId: {}'.format(lastMessageId))
-
-  else:
-    changes = ListHistory(service(account), 'me',
-                          getLastHistoryId(account, session))
+    historyId corresponding to this update, None if nothing changed.
+  '''
+  labels = LabelInfo.fetch(account)
+  with lock:
+    LabelInfo.addLabels(session, account, labels)
+    attachmentLabel = LabelInfo.attachmentLabel(session, account)
+  newMessages, otherChanges, unreadChanged = False, False, False
+  historyId = None
+
+  for changes in iterHistoryPages(service(account), 'me', lastHistoryId):
+    if not changes:
+      continue
     messagesAdded, messagesDeleted = [], []
-    labelsAdded, labelsRemoved = [], []
+    # The net effect of the page on each (messageId, labelId), the history
+    # is in order so later records win.
+    labelChanges = {}
 
     for change in changes:
       if 'messagesAdded' in change:
@@ -141,38 +153,195 @@ def updateDb(account,
       if 'messagesDeleted' in change:
         messagesDeleted += [c['message']['id'] for c in
                             change['messagesDeleted']]
-      if 'labelsAdded' in change:
-        labelsAdded += [(c['message']['id'], c['labelIds']) for c in
-                        change['labelsAdded']]
-      if 'labelsRemoved' in change:
-        labelsRemoved += [(c['message']['id'], c['labelIds']) for c in
-                          change['labelsRemoved']]
-
-    MessageInfo.addMessages(session, account, service(account), messagesAdded)
-
-    if len(messagesAdded) > 0:
-      # Set newMessagesArrived to be true, this will cause the Cache
-      # (savedQuery) to be updated.
-      logger.info('There are new messages!')
-      newMessagesArrived.set()
-
-      if config.afterUnreadChange:
-        os.system(config.afterUnreadChange)
-
-    MessageInfo.removeMessages(session, messagesDeleted)
-    Labels.addLabels(session, labelsAdded)
-    Labels.removeLabels(session, labelsRemoved)
-    LabelInfo.addLabels(session, account)
-
-    if len(changes) > 0:
-      lastHistoryId = str(max([int(change['id']) for change in changes]))
-    else:
-      lastHistoryId = None
-    lastMessageId = None
+      for c in change.get('labelsAdded', []):
+        for labelId in c['labelIds']:
+          labelChanges[(c['message']['id'], labelId)] = True
+      for c in change.get('labelsRemoved', []):
+        for labelId in c['labelIds']:
+          labelChanges[(c['message']['id'], labelId)] = False
+
+    labelsAdded, labelsRemoved = {}, {}
+    for (messageId, labelId), added in labelChanges.items():
+      (labelsAdded if added else labelsRemoved)\
+          .setdefault(messageId, []).append(labelId)
+    historyId = max(int(change['id']) for change in changes)
+    messages, parts = fetchPage(
+        account, session, service(account), lock, messagesAdded,
+        [messageId for (messageId, labelId), added in labelChanges.items()
+         if added and labelId == attachmentLabel])
+
+    # Everything from a page of history is written in one transaction,
+    # together with the historyId it brings the db up to.
+    with lock:
+      MessageInfo.storeMessages(session, account, messages)
+      MessageInfo.removeMessages(session, messagesDeleted, commit=False)
+      Labels.addLabels(session, list(labelsAdded.items()), commit=False)
+      Labels.removeLabels(session, list(labelsRemoved.items()), commit=False)
+      Attachments.storeParts(session, parts)
+      session.query(UserInfo).get(account).historyId = historyId
+      notifyChange(session, 'HISTORY_SYNCED',
+                   {'account': account,
+                    'historyId': historyId,
+                    'messages': len(messagesAdded) + len(messagesDeleted) > 0,
+                    'labels': len(labelChanges) > 0})
+      commitChanges(session)
+
+    newMessages = newMessages or len(messagesAdded) > 0
+    otherChanges = otherChanges or \
+        len(messagesDeleted) + len(labelChanges) > 0
+    unreadChanged = unreadChanged or \
+        any(labelId == 'UNREAD' for (_, labelId) in labelChanges)
+
+  if newMessages:
+    # Set newMessagesArrived to be true, this will cause subscribed
+    # clients to redraw.
+    logger.info('There are new messages!')
+    newMessagesArrived.set()
+  elif otherChanges:
+    # Nothing new, but clients should redraw.
+    newMessagesArrived.set('LabelsChanged')
+
+  if config.afterUnreadChange and (newMessages or unreadChanged):
+    os.system(config.afterUnreadChange)
+  return historyId
+
+
+def fetchPage(account, session, service, lock, messageIds,
+              attachmentIds=()):
+  '''
+  Get what is needed to store a page of a sync from gmail: the messages
+  which are not in the db yet, and the parts of those which have the
+  ATTACHMENT label or are in attachmentIds. The lock is only held to look
+  at the db, not while gmail answers. The caller stores the page with
+  MessageInfo.storeMessages and then Attachments.storeParts.
 
-  if lastMessageId:
-    lastHistoryId = session.query(MessageInfo).get(lastMessageId).historyId
-  return lastHistoryId
+  Args:
+    account: The account being synced.
+    session: DB session.
+    service: The google API sevice object.
+    lock: threading.Lock()
+    messageIds: Ids of messages to add.
+    attachmentIds: Ids of messages already in the db whose attachments
+    should be looked at.
+
+  Returns:
+    A pair of lists of responses, (messages, parts).
+  '''
+  with lock:
+    messageIds = MessageInfo.missing(session, messageIds)
+    attachmentIds = Attachments.pending(session, attachmentIds)
+    attachmentLabel = LabelInfo.attachmentLabel(session, account)
+  messages = MessageInfo.fetch(service, messageIds)
+  attachmentIds += [m['id'] for m in messages
+                    if attachmentLabel in m.get('labelIds', [])]
+  return messages, Attachments.fetch(service, attachmentIds)
+
+
+# Maximum number of message ids gmail lists at a time.
+SYNC_PAGE_SIZE = 500
+
+
+def initialSync(account, session, service, newMessagesArrived, lock):
+  '''
+  The first sync of an account, which stores the messages newer than
+  config.syncFrom. The messages are listed and stored a page at a time, and
+  each page is committed together with where the sync has got to (the
+  UserInfo.sync* columns), so a sync which is interrupted carries on from
+  the last page it stored. Each page is fetched from gmail without holding
+  the lock, which is only taken to store it, so clients can use what has
+  been synced so far. The progress is pushed to them as SyncProgress events.
+
+  Changes made to the mailbox while syncing are picked up by the first
+  partial update, which starts at the historyId of the mailbox when the sync
+  started.
+
+  Args:
+    account: The account to sync.
+    session: DB session.
+    service: Function which makes a google API service object.
+    newMessagesArrived: NotifyingEvent()
+    lock: threading.Lock()
+
+  Returns:
+    None
+  '''
+  with lock:
+    ui = session.query(UserInfo).get(account)
+    syncHistoryId = ui.syncHistoryId
+  if syncHistoryId is None:
+    profile = execute(service(account).users().getProfile(userId='me'))
+    labels = LabelInfo.fetch(account)
+    with lock:
+      # Labels first, so that messages with attachments can be recognised.
+      LabelInfo.addLabels(session, account, labels)
+      ui.syncHistoryId = int(profile['historyId'])
+      ui.syncPageToken = None
+      ui.syncFetched = 0
+      ui.syncTotal = None
+      session.commit()
+  else:
+    logger.info('Resuming the sync of {} after {} messages.'
+                .format(account, ui.syncFetched))
+
+  started, startedAt = time(), ui.syncFetched
+  done = False
+  while not done:
+    try:
+      pages = iterMessagePages(service(account), 'me',
+                               query='newer_than:' + config.syncFrom,
+                               pageToken=ui.syncPageToken,
+                               maxResults=SYNC_PAGE_SIZE)
+      for page in pages:
+        messageIds = [m['id'] for m in page.get('messages', [])]
+        messages, parts = fetchPage(account, session, service(account), lock,
+                                    messageIds)
+
+        with lock:
+          MessageInfo.storeMessages(session, account, messages)
+          Attachments.storeParts(session, parts)
+          ui.syncPageToken = page.get('nextPageToken')
+          ui.syncFetched += len(messageIds)
+          ui.syncTotal = max(
+              ui.syncTotal or page.get('resultSizeEstimate', 0),
+              ui.syncFetched)
+          progress = {'event': 'SyncProgress',
+                      'account': account,
+                      'fetched': ui.syncFetched,
+                      'total': ui.syncTotal}
+          notifyChange(session, 'HISTORY_SYNCED',
+                       {'account': account,
+                        'historyId': ui.syncHistoryId,
+                        'messages': True,
+                        'labels': False})
+          done = ui.syncPageToken is None
+          if done:
+            ui.historyId = ui.syncHistoryId
+            ui.shouldIupdate = False
+            ui.syncHistoryId = ui.syncFetched = ui.syncTotal = None
+          commitChanges(session)
+
+        if messageIds:
+          newMessagesArrived.set()
+        rate = (progress['fetched'] - startedAt) / \
+            max(time() - started, 1e-3)
+        progress['rate'] = rate
+        progress['eta'] = (progress['total'] - progress['fetched']) / rate \
+            if rate > 0 else None
+        progress['done'] = done
+        newMessagesArrived.notifier.publish(progress)
+        logger.info('Synced {fetched} of about {total} messages of '
+                    '{account}.'.format(**progress))
+    except HttpError as e:
+      if ui.syncPageToken is None or e.resp.status != 400:
+        raise
+      # The page token expired, start listing again. The messages which are
+      # already stored are skipped.
+      logger.warning('Sync page token expired, listing {} again.'
+                     .format(account))
+      with lock:
+        ui.syncPageToken = None
+        ui.syncFetched = startedAt = 0
+        session.commit()
 
 # <---
 
@@ -181,13 +350,13 @@ def updateDb(account,
 
 def getMessages(s, Q, newMessagesArrived, account, query, position,
                 height, excludedLabels=[],
-                includedLabels=[], count=False, afterAction=None):
+                includedLabels=[], count=False):
   '''
   Get a list of messages to display.
 
   Args:
     account: The currently selected account.
-    query: list of messageIds.
+    query: The handle of a set of search results, or None for no search.
     position: The position of the currently highlighted message.
     height: The height of the stdscr.
     excludedLabels: Any labels to exclude,
@@ -195,283 +364,926 @@ def getMessages(s, Q, newMessagesArrived, account, query, position,
     count: if True then only return the count.
 
   Returns:
-    Either a list of MessageInfo objects or
+    Either a page of messages encoded with encodeMessages or
     an integer (depending on truthiness of count).
   '''
   if newMessagesArrived.is_set():
-    logger.info('New messages arrived, refreshing the cache.')
-    q = Q.getQuery(s, account, query, includedLabels,
-                   excludedLabels, refresh=True)
+    # The cached views were patched as the new messages were stored.
     newMessagesArrived.clear()
-  elif afterAction is None:
-    q = Q.getQuery(s, account, query, includedLabels, excludedLabels)
-  elif afterAction['action'] in ['DELETE', 'TRASH']:
-    logger.info('Removing message: {} from cache.'
-                .format(afterAction['messageIds']))
-    q = Q.removeMessages(afterAction['messageIds'])
-  elif afterAction['action'] in ['MARK_AS_READ']:
-    # logger.info('removing msg from cache')
-    logger.info('Refreshing the cache, after reading.')
-    # q = Q.markAsRead(afterAction['messageIds'])
-    q = Q.getQuery(s, account, query, includedLabels,
-                   excludedLabels, refresh=True)
+  view = Q.getQuery(s, account, query, includedLabels, excludedLabels)
   if count is False:
-    # return [h for h in q.slice(position, position + height - 2)]
-    return q[position:position + height - 2]
+    return encodeMessages(view.page(s, max(position, 0), height - 2))
   elif count is True:
-    # return q.count()
-    return len(q)
+    return view.getCount(s)
+
+
+class MessageView():
+  '''
+  The messages matching an (account, query, includedLabels, excludedLabels)
+  combination, newest first. Rather than the whole list only a window of rows
+  around what the client is looking at is kept, together with the number of
+  matching messages.
+
+  Messages are ordered by (time, messageId) which is unique, so the window can
+  be moved with keyset queries ("the next n messages older than this one")
+  which only read the rows they return. An OFFSET query is only needed when
+  jumping somewhere which does not touch the current window, e.g. 'G'.
+  '''
+  # How many rows to fetch either side of the requested page.
+  PREFETCH_MARGIN = 50
+
+  def __init__(self, account, query, includedLabels, excludedLabels,
+               results=None):
+    self.account = account
+    # The handle of a set of search results, see SearchResults, and the
+    # messageIds in it.
+    self.query = query
+    self.querySet = results
+    self.includedLabels = includedLabels
+    self.excludedLabels = excludedLabels
+    # Rough number of bytes used by querySet, it never changes so it is
+    # only measured once.
+    self.querySize = 0 if results is None else sys.getsizeof(results) + \
+        sum(sys.getsizeof(messageId) for messageId in results)
+    self.reset()
+
+  def reset(self):
+    '''
+    Forget the window and the count.
+    '''
+    # Number of matching messages, None if it needs to be counted.
+    self.count = None
+    # MessageSummary objects for positions start, start + 1, ...
+    self.start = 0
+    self.rows = []
+    # Rough number of bytes used by self.rows, kept up to date as rows are
+    # added and removed.
+    self.rowsSize = 0
+    # True if the last row of self.rows is the oldest matching message.
+    self.atEnd = False
+
+  def approxSize(self):
+    '''
+    Rough number of bytes used by the view.
+    '''
+    return self.querySize + self.rowsSize
+
+  def _filter(self, s, q):
+    '''
+    Restrict q to the messages in this view.
+    '''
+    excludeQuery = s.query(Labels.messageId).filter(
+        Labels.labelId.in_(self.excludedLabels))
+    includeQuery = s.query(Labels.messageId).filter(
+        Labels.labelId.in_(self.includedLabels))
+    q = q.filter(~MessageInfo.messageId.in_(excludeQuery),
+                 MessageInfo.messageId.in_(includeQuery))
+    if self.account:
+      q = q.filter(MessageInfo.emailAddress == self.account)
+    if self.query is not None:
+      q = q.filter(MessageInfo.messageId.in_(
+          s.query(SearchResults.messageId)
+          .filter(SearchResults.handle == self.query)))
+    return q
+
+  def getCount(self, s):
+    '''
+    Number of messages in the view, without loading any of them.
+    '''
+    if self.count is None:
+      q = self._filter(s, s.query(func.count(MessageInfo.messageId)))
+      self.count = q.scalar()
+    return self.count
+
+  def _fetch(self, s, limit, offset=0, olderThan=None, newerThan=None):
+    '''
+    Fetch up to limit rows, either at offset or just before/after a row.
+
+    Args:
+      s: db session.
+      limit: Maximum number of rows.
+      offset: Number of rows to skip.
+      olderThan: MessageSummary, only fetch messages after it in the list.
+      newerThan: MessageSummary, only fetch messages before it in the list.
+
+    Returns:
+      List of MessageSummary objects in list order.
+    '''
+    if limit <= 0:
+      return []
+    q = self._filter(s, s.query(*MessageSummary.columns()))
+    if olderThan:
+      q = q.filter(or_(MessageInfo.time < olderThan.time,
+                       and_(MessageInfo.time == olderThan.time,
+                            MessageInfo.messageId < olderThan.messageId)))
+    if newerThan:
+      q = q.filter(or_(MessageInfo.time > newerThan.time,
+                       and_(MessageInfo.time == newerThan.time,
+                            MessageInfo.messageId > newerThan.messageId)))\
+          .order_by(MessageInfo.time.asc(), MessageInfo.messageId.asc())
+      rows = q.limit(limit).all()
+      rows.reverse()
+    else:
+      q = q.order_by(MessageInfo.time.desc(), MessageInfo.messageId.desc())
+      rows = q.offset(offset).limit(limit).all()
+    return MessageSummary.fromRows(s, rows)
+
+  def page(self, s, position, size):
+    '''
+    Get the messages at positions position, ..., position + size - 1.
+
+    Args:
+      s: db session.
+      position: Position of the first message.
+      size: Number of messages.
+
+    Returns:
+      List of MessageSummary objects.
+    '''
+    end = self.start + len(self.rows)
+    if not (self.start <= position and
+            (position + size <= end or self.atEnd)):
+      self._moveWindow(s, position, size)
+    return self.rows[position - self.start:position - self.start + size]
+
+  def _moveWindow(self, s, position, size):
+    '''
+    Move the window so that it covers position, ..., position + size - 1,
+    plus PREFETCH_MARGIN rows either side.
+    '''
+    lo = max(0, position - self.PREFETCH_MARGIN)
+    hi = position + size + self.PREFETCH_MARGIN
+    start, end = self.start, self.start + len(self.rows)
+
+    if self.rows and lo <= end and hi >= start:
+      # The new window touches the old one, extend it with keyset queries.
+      before = self._fetch(s, start - lo, newerThan=self.rows[0])
+      after = [] if self.atEnd else\
+          self._fetch(s, hi - end, olderThan=self.rows[-1])
+      rows = before + self.rows + after
+      start = start - len(before)
+      atEnd = self.atEnd or len(after) < hi - end
+    else:
+      logger.info('Fetching messages at offset {}.'.format(lo))
+      rows = self._fetch(s, hi - lo, offset=lo)
+      start = lo
+      atEnd = len(rows) < hi - lo
+
+    # Trim back down to [lo, hi).
+    self.rows = rows[max(lo - start, 0):hi - start]
+    self.rowsSize = sum(m.approxSize() for m in self.rows)
+    self.atEnd = atEnd and start + len(rows) <= hi
+    self.start = max(lo, start)
+
+  # ---> Patching the view
+
+  def contains(self, m):
+    '''
+    Check if a message belongs in this view.
+
+    Args:
+      m: MessageSummary object.
+    '''
+    return ((not self.account or m.emailAddress == self.account) and
+            (self.query is None or m.messageId in self.querySet) and
+            any(label in self.includedLabels for label in m.labelIds) and
+            not any(label in self.excludedLabels for label in m.labelIds))
+
+  def _index(self, m):
+    '''
+    Binary search for the index in self.rows where m belongs.
+    '''
+    key = (m.time, m.messageId)
+    lo, hi = 0, len(self.rows)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if (self.rows[mid].time, self.rows[mid].messageId) > key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _find(self, messageId):
+    for m in self.rows:
+      if m.messageId == messageId:
+        return m
+
+  def insert(self, m):
+    '''
+    A message which was not in the view now is.
+    '''
+    if self.count is not None:
+      self.count += 1
+    if not self.rows and not self.atEnd:
+      # Nothing fetched yet.
+      return
+    i = self._index(m)
+    if i == 0 and self.start > 0:
+      # Before the window, which moves down by one.
+      self.start += 1
+    elif i == len(self.rows) and not self.atEnd:
+      # After the window.
+      pass
+    else:
+      self.rows.insert(i, m)
+      self.rowsSize += m.approxSize()
+
+  def remove(self, m):
+    '''
+    A message which was in the view no longer is.
+    '''
+    if self.count is not None:
+      self.count -= 1
+    i = self._index(m)
+    if i < len(self.rows) and self.rows[i].messageId == m.messageId:
+      self.rowsSize -= self.rows[i].approxSize()
+      del self.rows[i]
+    elif i == 0 and self.start > 0:
+      self.start -= 1
+
+  def patchMessage(self, old, new):
+    '''
+    Patch the view after a message changed.
+
+    Args:
+      old: MessageSummary of the message before the change, None if it is
+      a new message.
+      new: MessageSummary of the message after the change, None if it was
+      deleted.
+    '''
+    m = new or old
+    cached = self._find(m.messageId)
+    was = cached is not None or (old is not None and self.contains(old))
+    now = new is not None and self.contains(new)
+    if was and now:
+      if cached:
+        self.rowsSize += sys.getsizeof(new.labelIds) - \
+            sys.getsizeof(cached.labelIds)
+        cached.labelIds = new.labelIds
+    elif was:
+      self.remove(cached or old)
+    elif now:
+      self.insert(new)
+
+  def removeMessages(self, messageIds):
+    '''
+    Messages were deleted from the db.
+
+    Args:
+      messageIds: List of messageIds which were deleted.
+    '''
+    rows = [m for m in self.rows if m.messageId not in messageIds]
+    removed = len(self.rows) - len(rows)
+    if removed == len(set(messageIds)) and self.count is not None:
+      # Everything removed was in the window, so it is still accurate.
+      self.rowsSize -= sum(m.approxSize() for m in self.rows
+                           if m.messageId in messageIds)
+      self.rows = rows
+      self.count -= removed
+    else:
+      # We can not tell where the others were, start again.
+      self.reset()
+
+  # <---
 
 
 class SaveQuery():
   '''
   Class which acts as a cache so that the db does not need to be queried
   unnessessairly. The main reason this is needed is to ensure that scolling
-  remains smooth, untested with really large numbers of messages (>6000). If
-  the number of messages gets too large this might need refinements.
+  remains smooth. Only a window of the messages in each view is held, see
+  MessageView, so this stays cheap for very large mailboxes.
+
+  The most recently used views are kept, so that flipping between e.g. the
+  INBOX and UNREAD or between accounts does not start from scratch. Views
+  are evicted least recently used first once there are more than
+  config.viewCacheEntries of them or they take up more than roughly
+  config.viewCacheMemory bytes.
   '''
 
   def __init__(self):
-    self.account = None
-    self.query = None
-    self.includedLabels = None
-    self.excludedLabels = None
-    # self.savedQuery: List of messages mathing query - i.e. the evaluated
-    # query.
-    self.savedQuery = None
-
-  def getQuery(self, s, account, query, includedLabels,
-               excludedLabels, refresh=False):
-    '''
-    Method to getQuery, checks if any of the parameters has changed, if not
-    then it just uses the cached query, if something changed then we ask the
-    db.
+    # self.views: MessageView objects, least recently used first.
+    self.views = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.searches = SearchCache()
+
+  def search(self, s, account, searchTerms, messageIds=None):
+    '''
+    Get the results of a search, see SearchCache.
+
+    Args:
+      s: db session.
+      account: The account to search, None for all accounts.
+      searchTerms: What to search for.
+      messageIds: Messages found by gmail, None if gmail was not asked.
+
+    Returns:
+      The handle of the results, or None if gmail needs to be asked first.
+    '''
+    handle = self.searches.get(account, searchTerms)
+    if handle is not None and messageIds is None:
+      return handle
+    if messageIds is None and self.searches.needsGmail(searchTerms):
+      return None
+    handle = SearchResults.create(s, account, searchTerms, messageIds or [])
+    evicted = self.searches.add(s, account, searchTerms, handle,
+                                messageIds is not None)
+    for key in [key for key in self.views if key[1] in evicted]:
+      del self.views[key]
+    return handle
+
+  @staticmethod
+  def _key(account, query, includedLabels, excludedLabels):
+    return (account, query, tuple(includedLabels), tuple(excludedLabels))
+
+  def getQuery(self, s, account, query, includedLabels, excludedLabels):
+    '''
+    Method to getQuery, checks if we have a view for these parameters, if so
+    then it just uses the cached view, if not then we make a new one.
     Args:
       s: db session.
       account: The account which we need to get a query for.
-      query: This is a db query, possibly resulting from doing a search.
+      query: The handle of a set of search results, or None.
       includedLabels: List consisting of lables to include.
       excludedLabels: List consisting of labels to exclude.
-      refresh: If true then we ask the db no matter what, this is incase new
-      messages showed up or messages got deleted etc...
     Returns:
-      List of messages mathcing query.
-    '''
-    # logger.info("read :{}.".format(read))
-    if (self.account == account and
-        str(self.query) == str(query) and
-        self.includedLabels == includedLabels and
-            self.excludedLabels == excludedLabels) and refresh == False:
-      logger.info('Using saved query.')
-      return self.savedQuery
+      MessageView matching query.
+    '''
+    key = self._key(account, query, includedLabels, excludedLabels)
+    if key in self.views:
+      self.hits += 1
+      self.views.move_to_end(key)
+      logger.info('Using saved query. ({} hits, {} misses)'
+                  .format(self.hits, self.misses))
     else:
-      excludeQuery = s.query(Labels.messageId).filter(
-          Labels.labelId.in_(excludedLabels))
-      includeQuery = s.query(Labels.messageId).filter(
-          Labels.labelId.in_(includedLabels))
-      # logger.info('Made two queries.')
-      if account:
-        q = s.query(MessageInfo)\
-            .filter(
-                MessageInfo.messageId.in_(query),
-                MessageInfo.emailAddress == account,
-                ~MessageInfo.messageId.in_(excludeQuery),
-                MessageInfo.messageId.in_(includeQuery))\
-            .order_by(MessageInfo.time.desc())
-      else:
-        q = s.query(MessageInfo)\
-            .filter(
-                MessageInfo.messageId.in_(query),
-                ~MessageInfo.messageId.in_(excludeQuery),
-                MessageInfo.messageId.in_(includeQuery))\
-            .order_by(MessageInfo.time.desc())
-      # logger.info('Successfully(?) refreshed the cache.')
-      self.account = account
-      self.query = query
-      self.includedLabels = includedLabels
-      self.excludedLabels = excludedLabels
-      self.savedQuery = list(q)
-      logger.info('Generating new query.')
-      return self.savedQuery
-
-  def removeMessages(self, messageIds):
+      self.misses += 1
+      results = None if query is None else\
+          SearchResults.messageIds(s, query)
+      self.views[key] = MessageView(account, query, includedLabels,
+                                    excludedLabels, results)
+      logger.info('Generating new query. ({} hits, {} misses)'
+                  .format(self.hits, self.misses))
+    self.evict()
+    return self.views[key]
+
+  def evict(self):
+    '''
+    Drop least recently used views until the cache is within its limits.
+    The most recently used view is always kept.
+    '''
+    size = sum(view.approxSize() for view in self.views.values())
+    while len(self.views) > 1 and (len(self.views) > config.viewCacheEntries
+                                   or size > config.viewCacheMemory):
+      key, view = self.views.popitem(last=False)
+      size -= view.approxSize()
+      logger.info('Evicted view {} from the cache.'.format(key[2:]))
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'views': len(self.views),
+            'size': sum(view.approxSize() for view in self.views.values())}
+
+  def patch(self, s, change, data):
     '''
-    Method to remove messages from the cache.
+    Change listener, see pmail.common.addChangeListener. Patches every
+    cached view in place, so that e.g. reading a message does not mean
+    rebuilding the list.
+
     Args:
-      messageIds: List of messageIds which we should remove.
-    Returns:
-      New list of messages.
+      s: db session.
+      change: One of 'LABELS_ADDED', 'LABELS_REMOVED', 'MESSAGES_ADDED',
+      'MESSAGES_REMOVED'.
+      data: List of (messageId, labelIds) pairs or list of messageIds.
     '''
-    self.savedQuery = [m for m in self.savedQuery if m.messageId not in
-                       messageIds]
-    return self.savedQuery
+    self.searches.patch(s, change, data)
+    if not self.views:
+      return
+    if change in ['LABELS_ADDED', 'LABELS_REMOVED']:
+      changed = {}
+      for (messageId, labelIds) in data:
+        changed.setdefault(messageId, set()).update(labelIds)
+      after = MessageSummary.load(s, changed.keys())
+      for messageId, new in after.items():
+        # Work out what the labels were before the change.
+        if change == 'LABELS_ADDED':
+          labelIds = [label for label in new.labelIds
+                      if label not in changed[messageId]]
+        else:
+          labelIds = new.labelIds + list(changed[messageId])
+        old = copy(new)
+        old.labelIds = labelIds
+        for view in self.views.values():
+          view.patchMessage(old, new)
+    elif change == 'MESSAGES_ADDED':
+      for new in MessageSummary.load(s, data).values():
+        for view in self.views.values():
+          view.patchMessage(None, new)
+    elif change == 'MESSAGES_REMOVED':
+      for view in self.views.values():
+        view.removeMessages(data)
+    else:
+      return
+    logger.info('Patched cached views after {}.'.format(change))
+
 
+class SearchCache():
   '''
-  # This didn't work - probably remove it later
-  def markAsRead(self, messageIds):
-    logger.info('Marking as read.')
-    newSavedQuery = []
-    for m in self.savedQuery:
-      logger.info('trying')
-      if m.messageId in messageIds:
-        logger.info('Found message with labels: {}'
-                    .format(m.labels))
-        m.labels = [l.label for l in m.labels if l.label != 'UNREAD']
-        logger.info('setting read to True on msg: {}'.format(m.messageId))
-      newSavedQuery.append(m)
-    self.savedQuery = newSavedQuery
-    return self.savedQuery
+  Keeps the sets of search results, see SearchResults, and remembers which
+  search each set came from so that repeating a search is free, in
+  particular one which had to go to gmail.
+
+  Each cached search is tagged with the historyId of each account at the
+  time, and updateDb reports every batch of history it applies with a
+  HISTORY_SYNCED change. A search is dropped from the cache when a later
+  batch could change its results: any batch which added or deleted
+  messages, and, for searches which went to gmail, e.g. label:, one which
+  changed labels. The results themselves are kept, since clients may still
+  be looking at them, until they are evicted.
   '''
+  # Number of sets of results kept, least recently used are deleted.
+  MAX_RESULTS = 16
+
+  def __init__(self):
+    # handle -> (account, normalized terms), least recently used first.
+    self.results = OrderedDict()
+    # (account, normalized terms) -> {'handle', 'historyIds', 'gmail'}
+    self.searches = {}
+
+  @staticmethod
+  def needsGmail(searchTerms):
+    return config.searchGmail or not MessageSearch.canSearch(searchTerms)
+
+  def get(self, account, searchTerms):
+    '''
+    Returns:
+      The handle of the results of an earlier identical search which are
+      still up to date, or None.
+    '''
+    search = self.searches.get((account,
+                                MessageSearch.normalize(searchTerms)))
+    if search is None:
+      return None
+    logger.info('Reusing the results of {}.'.format(searchTerms))
+    self.results.move_to_end(search['handle'])
+    return search['handle']
+
+  def add(self, s, account, searchTerms, handle, gmail):
+    '''
+    Remember a new set of results, deleting the least recently used sets if
+    there are too many. Does not commit.
+
+    Args:
+      s: db session.
+      account: The account searched, None for all accounts.
+      searchTerms: What was searched for.
+      handle: The handle of the results.
+      gmail: Whether gmail was asked.
+
+    Returns:
+      The handles of the deleted results.
+    '''
+    key = (account, MessageSearch.normalize(searchTerms))
+    q = s.query(UserInfo.emailAddress, UserInfo.historyId)
+    if account:
+      q = q.filter(UserInfo.emailAddress == account)
+    self.searches[key] = {
+        'handle': handle,
+        'historyIds': {a: int(h or 0) for (a, h) in q},
+        'gmail': gmail}
+    self.results[handle] = key
+    evicted = []
+    while len(self.results) > self.MAX_RESULTS:
+      oldHandle, oldKey = self.results.popitem(last=False)
+      if self.searches.get(oldKey, {}).get('handle') == oldHandle:
+        del self.searches[oldKey]
+      evicted.append(oldHandle)
+    SearchResults.remove(s, evicted)
+    return evicted
+
+  def patch(self, s, change, data):
+    '''
+    Change listener, see SaveQuery.patch. Forgets searches whose results
+    may have changed.
+    '''
+    if change != 'HISTORY_SYNCED':
+      return
+    account = data['account']
+    for key, search in list(self.searches.items()):
+      if key[0] not in (None, account) or \
+         data['historyId'] <= search['historyIds'].get(account, 0):
+        continue
+      if data['messages'] or (data['labels'] and search['gmail']):
+        logger.info('Search {} is out of date.'.format(key[1]))
+        del self.searches[key]
 
 # <---
 
 # ---> Main
 
+# Actions which never touch the db, these are answered straight away by the
+# event loop.
+CHEAP_ACTIONS = {'CHECK_FOR_NEW_MESSAGES'}
+
+
+class Notifier():
+  '''
+  Keeps track of clients which subscribed to events and pushes events to
+  them. Frames pushed this way have requestId None.
+  '''
+
+  def __init__(self):
+    self.loop = None
+    self.subscribers = set()
+
+  def subscribe(self, writer):
+    self.subscribers.add(writer)
+
+  def unsubscribe(self, writer):
+    self.subscribers.discard(writer)
+
+  def publish(self, event):
+    '''
+    Push an event to every subscribed client. Safe to call from any thread.
+
+    Args:
+      event: A dictionary, e.g. {'event': 'NewMsg'}.
+    '''
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self._publish, event)
+
+  def _publish(self, event):
+    frame = encodeFrame(dict(event, requestId=None))
+    for writer in list(self.subscribers):
+      if writer.is_closing():
+        self.unsubscribe(writer)
+      else:
+        writer.write(frame)
+
+
+class NotifyingEvent(Event):
+  '''
+  threading.Event() which also pushes an event to subscribed clients every
+  time it is set. Used for newMessagesArrived, so that clients hear about
+  changes as soon as the syncer has stored them instead of polling.
+  '''
+
+  def __init__(self, notifier):
+    Event.__init__(self)
+    self.notifier = notifier
+
+  def set(self, event='NewMsg'):
+    Event.set(self)
+    self.notifier.publish({'event': event})
+
+
+def handleRequest(s, Q, newMessagesArrived, request):
+  '''
+  Do something and return a response.
+
+  Args:
+    s: db session, None for CHEAP_ACTIONS.
+    Q: SaveQuery()
+    newMessagesArrived: threading.Event()
+    request: The unpickled request recieved from the client.
+
+  Returns:
+    The response which should be sent back to the client.
+  '''
+  action = request['action']
+  response = None
+  if action == 'CHECK_FOR_NEW_MESSAGES':
+    if newMessagesArrived.is_set():
+      response = 'newMessagesArrived'
+      # newMessagesArrived.clear()
+    else:
+      response = 'noNewMessages'
+  elif action == 'GET_MESSAGES':
+    # Get messages.
+    response = getMessages(s,
+                           Q,
+                           newMessagesArrived,
+                           request['account'],
+                           request['query'],
+                           request['position'],
+                           request['height'],
+                           request['excludedLabels'],
+                           request['includedLabels'],
+                           request['count'])
+  elif action == 'ADD_MESSAGES':
+    # Add messages, they were fetched by fetchForRequest.
+    MessageInfo.storeMessages(s, request['account'],
+                              request.get('messages', []))
+    Attachments.storeParts(s, request.get('parts', []))
+  elif action == 'GET_QUERY':
+    # get a query.
+    messageIds = request['messageIds']
+    cls = request['class']
+    response = [e for e in s.query(cls)
+                .filter(cls.messageId.in_(messageIds))]
+  elif action == 'SEARCH':
+    # The handle of the results, None if the client should ask gmail and
+    # send what it found in messageIds.
+    response = Q.search(s, request['account'], request['searchTerms'],
+                        request.get('messageIds'))
+  elif action == 'GET_ATTACHMENTS':
+    # The attachments of a message. They are normally stored during sync,
+    # messages synced before that was done are looked at now, see
+    # fetchForRequest.
+    messageId = request['messageId']
+    Attachments.storeParts(s, request.get('parts', []))
+    response = s.query(Attachments)\
+        .filter(Attachments.messageId == messageId)\
+        .order_by(Attachments.id).all()
+  elif action == 'REMOVE_LABELS':
+    # Remove labels.
+    labels = request['labels']
+    Labels.removeLabels(s, labels)
+  elif action == 'ADD_LABELS':
+    # Add labels.
+    labels = request['labels']
+    Labels.addLabels(s, labels)
+  # elif action == 'REMOVE_FALSE_ATTACMENTS':
+  #   # Remove false attachments.
+  #   messageId = request['messageId']
+  #   s.query(MessageInfo).filter(MessageInfo.messageId == messageId)\
+  #       .update({MessageInfo.hasAttachments: False},
+  #               synchronize_session='evaluate')
+  elif action == 'GET_LABEL_MAP':
+    # Get the labelMap - this feels a bit hacky...
+    response = LabelInfo.getName(s)
+  elif action == 'GET_CACHE_STATS':
+    # Hit/miss counters of the SaveQuery cache.
+    response = Q.stats()
+  else:
+    logger.warning('Recieved unknown action: {}'.format(action))
+  return response
+
+
+def fetchForRequest(s, lock, request):
+  '''
+  Get anything a request needs from gmail before the lock is taken to
+  handle it, so that other clients and the syncer are not held up while
+  gmail answers. What is fetched is added to the request.
+
+  Args:
+    s: db session.
+    lock: threading.Lock()
+    request: The unpickled request recieved from the client.
+
+  Returns:
+    None
+  '''
+  if request.get('action') == 'ADD_MESSAGES':
+    account = request['account']
+    request['messages'], request['parts'] = fetchPage(
+        account, s, mkService(account), lock, request['messageIds'])
+  elif request.get('action') == 'GET_ATTACHMENTS':
+    with lock:
+      pending = Attachments.pending(s, [request['messageId']])
+    request['parts'] = Attachments.fetch(mkService(request['account']),
+                                         pending)
+
+
+def handleFrame(lock, newMessagesArrived, Q, request):
+  '''
+  Handle one request inside a worker thread of the pool.
+
+  Args:
+    lock: threading.Lock()
+    newMessagesArrived: threading.Event()
+    Q: SaveQuery()
+    request: The unpickled request recieved from the client.
+
+  Returns:
+    The frame which should be sent back to the client.
+  '''
+  s = Session()
+  frame = {'requestId': request.get('requestId')}
+  try:
+    fetchForRequest(s, lock, request)
+    with lock:
+      try:
+        frame['response'] = handleRequest(s, Q, newMessagesArrived, request)
+        commitChanges(s)
+      except Exception:
+        s.rollback()
+        raise
+  except Exception:
+    logger.exception('Error while handling action: {}.'
+                     .format(request.get('action')))
+    frame['error'] = 'Server failed to handle {}.'\
+        .format(request.get('action'))
+  s.close()
+  return frame
+
 
-def pmailServer(lock, newMessagesArrived, Q):
+def indexBody(lock, messageId, raw):
   '''
-  Function which gets run by the server thread.
+  Add the body of a message to the search index, called when the body is
+  cached.
+
   Args:
+    lock: threading.Lock()
+    messageId: The id of the message.
+    raw: The raw message.
+
+  Returns:
+    None
+  '''
+  body = bodyText(raw)
+  s = Session()
+  with lock:
+    try:
+      MessageSearch.setBody(s, messageId, body)
+      s.commit()
+    except Exception:
+      logger.exception('Could not index the body of {}.'.format(messageId))
+      s.rollback()
+    s.close()
+
+
+def handleBodyFrame(bodies, request):
+  '''
+  Handle a GET_BODY request inside a worker thread of the pool. This needs
+  no db so it does not take the lock, and a slow download from gmail does
+  not hold anything else up.
+
+  Args:
+    bodies: BodyCache()
+    request: The unpickled request recieved from the client.
+
+  Returns:
+    The frame which should be sent back to the client.
+  '''
+  frame = {'requestId': request.get('requestId')}
+  try:
+    frame['response'] = bodies.fetch(request['account'],
+                                     request['messageId'])
+  except Exception:
+    logger.exception('Error while getting body of: {}.'
+                     .format(request.get('messageId')))
+    frame['error'] = 'Server failed to get the message.'
+  return frame
+
+
+async def serveConnection(reader, writer, pool, lock, newMessagesArrived, Q,
+                          notifier, bodies):
+  '''
+  Serve one client for as long as it stays connected.
+  Cheap requests are answered straight away on the event loop. Everything
+  else is handed to the worker pool, one request at a time per connection so
+  that a client sees its own requests handled in the order it sent them,
+  while other connections carry on being served.
+
+  Args:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    pool: concurrent.futures.ThreadPoolExecutor
     lock: threading.Lock()
     newMessagesArrived: threading.Event()
     Q: SaveQuery()
+    notifier: Notifier()
+    bodies: BodyCache()
   Returns:
     None
   '''
-  host = socket.gethostname()
-  port = config.port
-  bufferSize = 1024
+  loop = asyncio.get_event_loop()
+  address = writer.get_extra_info('peername')
+  logger.info('Connection from: {}.'.format(str(address)))
+  requests = asyncio.Queue()
+
+  async def worker():
+    while 1:
+      request = await requests.get()
+      if request is None:
+        break
+      frame = await loop.run_in_executor(
+          pool, handleFrame, lock, newMessagesArrived, Q, request)
+      writer.write(encodeFrame(frame))
+      await writer.drain()
+
+  async def sendBody(request):
+    frame = await loop.run_in_executor(pool, handleBodyFrame, bodies, request)
+    writer.write(encodeFrame(frame))
+
+  task = loop.create_task(worker())
+  try:
+    while 1:
+      request = await readFrame(reader)
+      if request['action'] == 'SUBSCRIBE':
+        # Push events to this client from now on.
+        notifier.subscribe(writer)
+        writer.write(encodeFrame({'requestId': request.get('requestId'),
+                                  'response': None}))
+      elif request['action'] == 'PREFETCH_BODIES':
+        bodies.prefetch(request['messages'])
+        writer.write(encodeFrame({'requestId': request.get('requestId'),
+                                  'response': None}))
+      elif request['action'] == 'GET_BODY':
+        # Answered out of order, as soon as the body is there.
+        loop.create_task(sendBody(request))
+      elif request['action'] in CHEAP_ACTIONS:
+        frame = {'requestId': request.get('requestId'),
+                 'response': handleRequest(None, Q, newMessagesArrived,
+                                           request)}
+        writer.write(encodeFrame(frame))
+      else:
+        requests.put_nowait(request)
+  except (asyncio.IncompleteReadError, ConnectionError):
+    pass
+  finally:
+    notifier.unsubscribe(writer)
+    requests.put_nowait(None)
+    try:
+      await task
+    except ConnectionError:
+      logger.warning('Lost connection to {}.'.format(str(address)))
+    logger.info('Closing connection to: {}.'.format(str(address)))
+    writer.close()
+
+
+def _unixSocketInUse(path):
+  '''
+  Check if another server is already listening on the unix socket at path.
+  A socket file left behind by a server which was killed is not in use.
+  '''
+  if not os.path.exists(path):
+    return False
+  sock = socket.socket(socket.AF_UNIX)
+  try:
+    sock.connect(path)
+    return True
+  except OSError:
+    return False
+  finally:
+    sock.close()
+
+
+async def _startServer(onConnect):
+  '''
+  Start listening, on a unix socket or on a tcp port depending on the
+  transport setting.
+  '''
+  if config.transport == 'unix':
+    path = config.socketPath
+    if _unixSocketInUse(path):
+      raise OSError('Socket {} is in use.'.format(path))
+    elif os.path.exists(path):
+      logger.info('Removing stale socket {}.'.format(path))
+      os.remove(path)
+    server = await asyncio.start_unix_server(onConnect, path)
+    os.chmod(path, 0o600)
+    logger.info('Listening on {}.'.format(path))
+  else:
+    server = await asyncio.start_server(onConnect, socket.gethostname(),
+                                        config.port)
+    logger.info('Listening on port {}.'
+                .format(config.port))
+  return server
+
 
-  portFree = True
-  while portFree is True:
+async def _pmailServer(lock, newMessagesArrived, Q, notifier, bodies):
+  '''
+  Bind the listening socket and serve clients until the loop is stopped.
+  '''
+  pool = ThreadPoolExecutor(max_workers=config.serverWorkers,
+                            thread_name_prefix='pmailWorker')
+  notifier.loop = asyncio.get_event_loop()
+
+  def onConnect(reader, writer):
+    return serveConnection(reader, writer, pool, lock, newMessagesArrived, Q,
+                           notifier, bodies)
+
+  server = None
+  while server is None:
     try:
-      sock = socket.socket()
-      sock.bind((host, port))
-      portFree = False
-      logger.info('Listening on port {}.'
-                  .format(config.port))
+      server = await _startServer(onConnect)
     except OSError as e:
       logger.info(e)
-      logger.warning('Port {} busy. Checking port again in 30s.'
-                     .format(config.port))
-      sleep(30)
-
-  s = Session()
-
-  # configure how many client the server can listen simultaneously
-  # only accept connections from client?
-  sock.listen(1)
-  while 1:
-    conn, address = sock.accept()
-    print("Connection from: {}.".format(str(address)))
-    sizeOfIncoming = int.from_bytes(conn.recv(4), 'big')
-    print(sizeOfIncoming)
-    incoming = b''
+      logger.warning('Address busy. Checking again in 30s.')
+      await asyncio.sleep(30)
 
-    while len(incoming) < sizeOfIncoming:
-      incoming += conn.recv(bufferSize)
+  async with server:
+    await server.serve_forever()
 
-    unpickledIncoming = pickle.loads(incoming, encoding='bytes')
 
-    # Do something and return a response.
-    action = unpickledIncoming['action']
-    with lock:
-      # logger.info('Server aquired the lock.')
-      if action == 'CHECK_FOR_NEW_MESSAGES':
-        if newMessagesArrived.is_set():
-          response = 'newMessagesArrived'
-          # newMessagesArrived.clear()
-        else:
-          response = 'noNewMessages'
-      elif action == 'GET_MESSAGES':
-        # Get messages.
-        incomingQ = unpickledIncoming['query']
-        query = s.query(
-            MessageInfo.messageId) if incomingQ is None else incomingQ
-        # logger.info('afterAction: {}'.format(unpickledIncoming['afterAction']))
-        response = getMessages(s,
-                               Q,
-                               newMessagesArrived,
-                               unpickledIncoming['account'],
-                               query,
-                               unpickledIncoming['position'],
-                               unpickledIncoming['height'],
-                               unpickledIncoming['excludedLabels'],
-                               unpickledIncoming['includedLabels'],
-                               unpickledIncoming['count'],
-                               unpickledIncoming['afterAction'])
-      elif action == 'ADD_MESSAGES':
-        # Add messages.
-        account = unpickledIncoming['account']
-        messageIds = unpickledIncoming['messageIds']
-        MessageInfo.addMessages(s, account, mkService(account), messageIds)
-        response = None
-      elif action == 'GET_QUERY':
-        # get a query.
-        messageIds = unpickledIncoming['messageIds']
-        cls = unpickledIncoming['class']
-        response = [e for e in s.query(cls)
-                    .filter(cls.messageId.in_(messageIds))]
-      elif action == 'REMOVE_LABELS':
-        # logger.info('Removing labels...')
-        # Remove labels.
-        # logger.info('Recieved instructions from client'
-        #             + '{}'.format(unpickledIncoming))
-        labels = unpickledIncoming['labels']
-        Labels.removeLabels(s, labels)
-        try:
-          account = unpickledIncoming['account']
-          incomingQ = unpickledIncoming['query']
-          query = s.query(
-              MessageInfo.messageId) if incomingQ is None else incomingQ
-          # query = unpickledIncoming['query']
-          includedLabels = unpickledIncoming['includedLabels']
-          excludedLabels = unpickledIncoming['excludedLabels']
-          # logger.info('Refreshing saved query.')
-          Q.getQuery(s, account, query, includedLabels,
-                     excludedLabels, refresh=True)
-        except KeyError:
-          pass
-        # except Exception:
-        #   logger.exception('Something unexpected happened.')
-        response = None
-        # response = Q.markAsRead([l[0] for l in labels])
-      elif action == 'ADD_LABELS':
-        # Add labels.
-        # logger.info('Recieved instructions from client'
-        #             + '{}'.format(unpickledIncoming))
-        labels = unpickledIncoming['labels']
-        Labels.addLabels(s, labels)
-        response = None
-      # elif action == 'REMOVE_FALSE_ATTACMENTS':
-      #   # Remove false attachments.
-      #   messageId = unpickledIncoming['messageId']
-      #   s.query(MessageInfo).filter(MessageInfo.messageId == messageId)\
-      #       .update({MessageInfo.hasAttachments: False},
-      #               synchronize_session='evaluate')
-      elif action == 'GET_LABEL_MAP':
-        # Get the labelMap - this feels a bit hacky...
-        labelMap = LabelInfo.getName(s)
-        # logger.info(labelMap)
-        response = labelMap
-
-    pickledResponse = pickle.dumps(response)
-    sizeOfPickle = len(pickledResponse)
-    numOfChunks = sizeOfPickle // bufferSize + 1
-    conn.send(sizeOfPickle.to_bytes(4, 'big'))
-
-    for i in range(numOfChunks):
-      conn.send(pickledResponse[i * bufferSize: (i + 1) * bufferSize])
-
-    # if action == 'REMOVE_LABELS':
-    #   for account in config.listAccounts():
-    #     UserInfo.update(s, account, None, None)
-    s.commit()
-    # logger.info('Closing database connection.')
-    s.close()
-    # logger.info('Closing socket connection.')
-    print('closing connection..')
-    conn.close()
+def pmailServer(lock, newMessagesArrived, Q, notifier, bodies):
+  '''
+  Function which gets run by the server thread. Runs an event loop which
+  serves any number of clients at once, database work happens in a pool of
+  worker threads.
+  Args:
+    lock: threading.Lock()
+    newMessagesArrived: NotifyingEvent()
+    Q: SaveQuery()
+    notifier: Notifier(), used to push events to subscribed clients.
+    bodies: BodyCache(), bodies of messages.
+  Returns:
+    None
+  '''
+  asyncio.run(_pmailServer(lock, newMessagesArrived, Q, notifier, bodies))
 
 
 '''
@@ -569,7 +1381,7 @@ def _syncDb_pubsub(session, pubSubQue, newMessagesArrived, lock, futures):
           'topicName': 'projects/{}/topics/pmail'.format(
               config.accounts[account]['project_id']
           )}
-      response = service.users().watch(userId='me', body=request).execute()
+      response = execute(service.users().watch(userId='me', body=request))
       ui.watchExpirey = response['expiration']
       with lock:
         logger.info('Sync function acquired lock. About to sync.')
@@ -578,6 +1390,9 @@ def _syncDb_pubsub(session, pubSubQue, newMessagesArrived, lock, futures):
     # Subscribe to pubsub topic.
     if not futures[account] or not futures[account].running():
       logger.info('Subscribing to pubsub topic for: {}'.format(account))
+      # Imported here since pubsub is slow to import and only needed with
+      # this update_policy.
+      from pmail.subscriber import subscribe
       futures[account] = subscribe(pubSubQue, account)
 
   try:
@@ -587,17 +1402,13 @@ def _syncDb_pubsub(session, pubSubQue, newMessagesArrived, lock, futures):
     pubSubQue.clear()
     account = json.loads(m.decode('utf-8'))['emailAddress']
     logger.info('There was in change in: {}'.format(account))
-    with lock:
-      logger.info('Sync function acquired lock. About to sync.')
-      __syncDb(session, account, newMessagesArrived)
-      return futures
+    __syncDb(session, account, newMessagesArrived, lock)
+    return futures
   except Empty:
     logger.info('Nothing detected, but updating anyway just in case.')
-    with lock:
-      logger.info('Sync function acquired lock. About to sync.')
-      for account in config.listAccounts():
-        __syncDb(session, account, newMessagesArrived)
-      return futures
+    for account in config.listAccounts():
+      __syncDb(session, account, newMessagesArrived, lock)
+    return futures
   except Exception:
     logger.exception('Error while getting something from the pubsub queue.')
 
@@ -626,42 +1437,45 @@ def _syncDb_freq(session, newMessagesArrived, lock):
         session.commit()
         logger.info('Created user info for: {}'.format(account))
   try:
-    with lock:
-      logger.info('Sync function acquired lock. About to sync.')
-      for account in config.listAccounts():
-        __syncDb(session, account, newMessagesArrived)
+    for account in config.listAccounts():
+      __syncDb(session, account, newMessagesArrived, lock)
   except Exception:
     logger.exception('Error while trying to sync local DB.')
   sleep(config.updateFreq)
 
 
-def __syncDb(session, account, newMessagesArrived):
+def __syncDb(session, account, newMessagesArrived, lock):
   '''
   Function which actually perfroms the sync, inner most function of the loop.
   Args:
     session: db session.
     account: Account which is being synched.
     newMessagesArrived: threading.Event()
+    lock: threading.Lock(), held while the db is written, but not while the
+    initial sync waits for gmail.
   Returns:
     None
   '''
-  ui = session.query(UserInfo).get(account)
-  if ui.shouldIupdate is False:
+  with lock:
+    ui = session.query(UserInfo).get(account)
+    lastHistoryId = ui.historyId
+  if ui.shouldIupdate is False and lastHistoryId is not None:
     lastHistoryId = updateDb(account, session, mkService,
-                             newMessagesArrived, getLastHistoryId(account,
-                                                                  session))
-    ui.update(session, account, None, lastHistoryId)
-    logger.info('Successful partial update for {}.'.format(account))
-
-  elif ui.shouldIupdate is True:
-    ui.shouldIupdate = False
-    lastHistoryId = updateDb(account, session, mkService, newMessagesArrived)
-    ui.update(session, account, mkService(account), lastHistoryId)
-    # UserInfo.succesfulUpdate(session, account)
+                             newMessagesArrived, lastHistoryId, lock)
+    with lock:
+      ui.update(session, account, None, lastHistoryId)
+      logger.info('Successful partial update for {}.'.format(account))
+      session.close()
+    return
+
+  # No history yet, so this is the first sync, or one which was interrupted.
+  initialSync(account, session, mkService, newMessagesArrived, lock)
+  with lock:
+    ui.update(session, account, mkService(account), ui.historyId)
     logger.info('Successful full update for {}.'.format(account))
     with open(os.path.join(config.pickleDir, 'synced.pickle'), 'wb') as f:
       pickle.dump(False, f)
-  session.close()
+    session.close()
 
 
 def syncDb(lock, newMessagesArrived):
@@ -708,9 +1522,22 @@ def start():
   # logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
   lock = Lock()
-  newMessagesArrived = Event()
+  notifier = Notifier()
+  newMessagesArrived = NotifyingEvent(notifier)
+  Q = SaveQuery()
+  addChangeListener(Q.patch)
+  s = Session()
+  SearchResults.clear(s)
+  s.close()
+  bodies = BodyCache(config.bodyCacheDir, config.bodyCacheSize)
+  # Indexing waits for the lock, so it is done off to the side rather than
+  # holding up whoever wanted the body.
+  indexer = ThreadPoolExecutor(max_workers=1)
+  bodies.onPut = lambda messageId, raw: indexer.submit(indexBody, lock,
+                                                       messageId, raw)
+  addChangeListener(bodies.patch)
   t1 = Thread(target=pmailServer,
-              args=(lock, newMessagesArrived, SaveQuery()),
+              args=(lock, newMessagesArrived, Q, notifier, bodies),
               daemon=True)
   t2 = Thread(target=syncDb, args=(lock, newMessagesArrived,))
   t1.start()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+'''
+Tests for the retries in pmail.quota. Run with:
+
+    python -m unittest discover tests
+'''
+
+# ---> Imports
+import unittest
+from unittest import mock
+import httplib2
+from googleapiclient.errors import HttpError
+from pmail import quota
+# <---
+
+
+class FakeRequest():
+  '''
+  Stands in for a googleapiclient HttpRequest, failing with each of errors
+  in turn and then succeeding.
+  '''
+
+  def __init__(self, methodId, errors):
+    self.methodId = methodId
+    self.errors = list(errors)
+    self.calls = 0
+
+  def execute(self, **kwargs):
+    self.calls += 1
+    if self.errors:
+      raise self.errors.pop(0)
+    return {'id': 'sent'}
+
+
+def httpError(status):
+  return HttpError(httplib2.Response({'status': status}), b'{}')
+
+
+class TestExecute(unittest.TestCase):
+
+  def setUp(self):
+    patches = [mock.patch.object(quota, 'backoff'),
+               mock.patch.object(quota.limiter, 'acquire')]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+
+  def test_send_is_not_retried_after_503(self):
+    request = FakeRequest('gmail.users.messages.send', [httpError(503)])
+    with self.assertRaises(HttpError):
+      quota.execute(request)
+    self.assertEqual(request.calls, 1)
+
+  def test_send_is_not_retried_after_a_dropped_connection(self):
+    request = FakeRequest('gmail.users.messages.send', [ConnectionError()])
+    with self.assertRaises(ConnectionError):
+      quota.execute(request)
+    self.assertEqual(request.calls, 1)
+
+  def test_send_is_retried_when_throttled(self):
+    request = FakeRequest('gmail.users.messages.send', [httpError(429)])
+    self.assertEqual(quota.execute(request), {'id': 'sent'})
+    self.assertEqual(request.calls, 2)
+
+  def test_get_is_retried_after_503(self):
+    request = FakeRequest('gmail.users.messages.get', [httpError(503)])
+    self.assertEqual(quota.execute(request), {'id': 'sent'})
+    self.assertEqual(request.calls, 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
+
+"""
+vim:foldmethod=marker foldmarker=--->,<---
+"""